@@ -2,14 +2,21 @@
 
 Project is controlled by CLI generated by typer library.
 """
+from collections import Counter
 from pathlib import Path
+from typing import Iterable, List, Optional
 import logging
 
 import typer
 
 from .data import RunningAnalysesData
 from .api_client import SpaceKnowClient
-from . import utils, progress
+from .release_store import ReleaseStore
+from .tile_store import TileStore
+from .detection_store import DetectionStore
+from .image_encoder import ImageEncoder
+from .tile_pyramid import PYRAMID_FORMATS
+from . import settings, utils, progress, prompts, costs
 
 
 logger = logging.getLogger(__name__)
@@ -37,6 +44,12 @@ def set_auth_token_to_api_client(space_know_client: SpaceKnowClient):
 
 api_client = SpaceKnowClient()
 set_auth_token_to_api_client(api_client)
+api_client.tile_store = TileStore(
+    settings.TILE_STORE_PATH, settings.TILE_STORE_MAX_SIZE
+)
+api_client.release_store = ReleaseStore(
+    settings.RELEASE_STORE_PATH, settings.RELEASE_STORE_TTL
+)
 
 
 app = typer.Typer(add_completion=False)
@@ -58,31 +71,237 @@ def user_info():
 
 
 @app.command(help="Run 'cars' detection over selected area.")
-def main(
+def main(  # pylint: disable=R0913,R0914
     geojson_name: str = typer.Argument(
         ..., help="File name of geojson file in data folder, without file extension."
-    )
+    ),
+    workers: int = typer.Option(
+        settings.TILE_DOWNLOAD_WORKERS,
+        min=1,
+        help="Number of tiles downloaded concurrently.",
+    ),
+    out_of_core: Optional[bool] = typer.Option(
+        None,
+        "--out-of-core/--in-memory",
+        help="Keep stitched imagery in memory-mapped file instead of memory, "
+        "by default decided by imagery size.",
+    ),
+    save_stitched: bool = typer.Option(
+        False, help="Save also stitched imagery without rendered objects."
+    ),
+    save_geojson: bool = typer.Option(
+        False, help="Save also detection tiles in GeoJSON format."
+    ),
+    output_format: str = typer.Option(
+        settings.OUTPUT_FORMAT,
+        help="Format of output images: png, webp (lossless), jpeg or raw (npy).",
+    ),
+    output_quality: Optional[int] = typer.Option(
+        settings.OUTPUT_QUALITY,
+        help="Compression level 0-9 of png or quality 0-100 of jpeg output images.",
+    ),
+    tile_pyramid: Optional[str] = typer.Option(
+        None,
+        help="Write result as tile pyramid with overviews instead of one image: "
+        "mbtiles (one SQLite file) or xyz (z/x/y directory tree).",
+    ),
+    image_workers: int = typer.Option(
+        settings.IMAGE_PROCESS_WORKERS,
+        min=0,
+        help="Number of processes stitching and rendering imagery of scenes, "
+        "0 to process imagery in main process.",
+    ),
+    reuse_releases: bool = typer.Option(
+        True,
+        help="Reuse Kraken releases of the same scene and area from previous runs.",
+    ),
+    batch_allocation: bool = typer.Option(
+        True, help="Allocate selected area for all selected scenes in one request."
+    ),
+    prefetch_imagery: bool = typer.Option(
+        True,
+        help="Download imagery in max. zoom in background, while zoom level "
+        "of scene is selected, max. zoom is then offered as default.",
+    ),
+    budget: Optional[float] = typer.Option(
+        None,
+        help="Max. total cost of allocated area, analysis is not started, "
+        "when estimated cost exceeds it (or remaining credits).",
+    ),
+    all_scenes: bool = typer.Option(
+        False,
+        help="Analyse all found scenes without prompt, analyses of first scenes "
+        "start while next pages of search result are loaded.",
+    ),
 ):
     """Run 'cars' analysis for selected area."""
+    if not reuse_releases:
+        api_client.release_store = None
+    ra_data = RunningAnalysesData()
+    ra_data.download_workers = workers
+    ra_data.out_of_core = out_of_core
+    ra_data.save_stitched_imagery = save_stitched
+    ra_data.save_detection_geojson = save_geojson
+    ra_data.image_workers = image_workers
+    ra_data.batch_allocation = batch_allocation
+    ra_data.prefetch_imagery = prefetch_imagery
+    try:
+        ra_data.encoder = ImageEncoder(output_format, output_quality)
+    except ValueError as error:
+        raise typer.BadParameter(str(error)) from error
+    if out_of_core and tile_pyramid is None and not ra_data.encoder.is_streamed:
+        raise typer.BadParameter(
+            f"Out-of-core imagery cannot be encoded into {output_format}, "
+            "use png or raw format, or tile pyramid."
+        )
+    if tile_pyramid is not None:
+        if tile_pyramid not in PYRAMID_FORMATS:
+            raise typer.BadParameter(f"Unsupported tile pyramid: {tile_pyramid}")
+        if output_format == "raw":
+            raise typer.BadParameter("Tile pyramid cannot be in raw format.")
+    ra_data.tile_pyramid = tile_pyramid
+    api_client.configure_pool(workers)
+    ra_data.selected_area = progress.load_geojson(geojson_name)
+
+    if all_scenes:
+        scene_id_pages = costs.limit_scene_pages_by_budget(
+            api_client,
+            ra_data,
+            progress.search_scene_pages(api_client, ra_data),
+            budget,
+        )
+    else:
+        search_scenes(ra_data)
+        selected_imagery_index = prompts.select_imagery(ra_data)
+        ra_data.select_scene(selected_imagery_index)
+        estimates = costs.estimate_costs(
+            api_client,
+            ra_data,
+            costs.get_scenes_to_allocate(
+                api_client, ra_data.selected_scenes, ra_data.selected_area
+            ),
+        )
+        costs.check_budget(api_client, estimates, budget)
+        scene_id_pages = ()
+    ra_data.checkpoint_path = settings.CHECKPOINT_PATH
+    ra_data.save_checkpoint()
+
+    run_analyses(ra_data, scene_id_pages)
+
+
+@app.command(help="Estimate cost of 'cars' detection over selected area.")
+def estimate(
+    geojson_name: str = typer.Argument(
+        ..., help="File name of geojson file in data folder, without file extension."
+    ),
+    budget: Optional[float] = typer.Option(
+        None, help="Max. total cost, exit with error code, when it is exceeded."
+    ),
+):
+    """Print area and cost of allocating selected area for all found scenes."""
     ra_data = RunningAnalysesData()
     ra_data.selected_area = progress.load_geojson(geojson_name)
+    search_scenes(ra_data)
+    estimates = costs.estimate_costs(
+        api_client,
+        ra_data,
+        [scene_data["sceneId"] for scene_data in ra_data.scenes_list],
+    )
+    costs.check_budget(api_client, estimates, budget)
+
+
+@app.command(help="Resume interrupted 'cars' detection from the last checkpoint.")
+def resume(
+    retry_failed: bool = typer.Option(
+        True, help="Run again failed scenes, from their failed stage."
+    ),
+):
+    """Resume analysis from checkpoint saved by interrupted 'main' command.
+
+    Done stages are not run again, tiles saved in 'result' folder
+    are not downloaded again.
+    """
+    try:
+        ra_data = RunningAnalysesData.load_checkpoint(settings.CHECKPOINT_PATH)
+    except FileNotFoundError as error:
+        typer.echo("No checkpoint found, nothing to resume.", err=True)
+        raise typer.Exit(1) from error
+    if retry_failed:
+        ra_data.failed_scene_ids.clear()
+    api_client.configure_pool(ra_data.download_workers)
+    typer.echo(f"Resuming analysis of scenes: {len(ra_data.selected_scenes)}")
+    run_analyses(ra_data)
+
 
+def search_scenes(ra_data: RunningAnalysesData):
+    """Search scenes (imagery) of selected area and register them."""
     search_pipeline = progress.search_imagery(api_client, ra_data.selected_area)
     progress.wait_pipeline(api_client, search_pipeline)
     list_imagery_data = progress.retrieve_imagery(api_client, search_pipeline)
     ra_data.register_scenes(list_imagery_data)
-    selected_imagery_index = progress.select_imagery(ra_data)
-    ra_data.select_scene(selected_imagery_index)
 
-    progress.run_analysis_pipelines(api_client, ra_data)
-    progress.process_cars_analysis_pipelines(api_client, ra_data)
-    progress.process_imagery_analysis_pipelines(api_client, ra_data)
-    progress.render_detected_items_into_imageries(ra_data)
-    progress.count_detected_items(ra_data)
+
+def run_analyses(
+    ra_data: RunningAnalysesData, scene_id_pages: Iterable[List[str]] = ()
+):
+    """Run analyses of selected scenes and print stats.
+
+    :param scene_id_pages: Pages of scenes analysed as soon as they are found,
+        see progress.run_scenes_analyses
+    """
+    detection_store = DetectionStore(settings.DETECTION_STORE_PATH)
+    progress.run_scenes_analyses(api_client, ra_data, detection_store, scene_id_pages)
+    api_client.tile_store.flush()
 
     typer.echo("\n-------------------------------------------------------------")
     typer.echo("Analysis done, see 'result' folder for generated data. Stats:")
     ra_data.print_stats()
 
 
+@app.command(help="Print objects detected in all analysed scenes.")
+def detections(
+    geojson_name: Optional[str] = typer.Argument(
+        None, help="File name of geojson file in data folder, without file extension."
+    ),
+    feature_class: Optional[str] = typer.Option(
+        None, "--class", help="Class of detected objects, e.g. 'cars' or 'trucks'."
+    ),
+    start: Optional[str] = typer.Option(
+        None, help="Only scenes taken at or after it, e.g. '2018-01-01'."
+    ),
+    end: Optional[str] = typer.Option(
+        None, help="Only scenes taken before it, e.g. '2018-02-01'."
+    ),
+):
+    """Print number of detected objects per scene from detection store."""
+    area = progress.load_geojson(geojson_name) if geojson_name else None
+    detection_store = DetectionStore(settings.DETECTION_STORE_PATH)
+    detected_objects = detection_store.query(area, feature_class, start, end)
+    # fragments of one object split by tile border are counted once
+    objects = {
+        (
+            detected_object.datetime,
+            detected_object.scene_id,
+            detected_object.feature_class,
+            detected_object.object_id
+            if detected_object.object_id is not None
+            else -detected_object.detection_id,
+        )
+        for detected_object in detected_objects
+    }
+    counts = Counter(scene_object[:3] for scene_object in objects)
+    for (datetime, scene_id, row_class), count in sorted(counts.items()):
+        typer.echo(f"{datetime}, scene: {scene_id}, {row_class}: {count}")
+    typer.echo(f"Detected objects: {len(objects)} total")
+
+
+@app.command(help="Export binary detection tiles of scene into GeoJSON files.")
+def export_detections(
+    scene_id: str = typer.Argument(..., help="ID of scene in 'result' folder."),
+):
+    """Export binary detection tiles of scene into GeoJSON files."""
+    exported_count = progress.export_detection_tiles(scene_id)
+    typer.echo(f"Exported detection tiles: {exported_count}")
+
+
 app()
@@ -15,7 +15,7 @@ class CreditsApi:
     def get_remaining_credit(self) -> float:
         """Get user remaining credit."""
         url = f"{self.BASE_URL}/get-remaining-credit"
-        data = self.api_client.send_post_query(url)
+        data = self.api_client.send_post_query(url, idempotent=True)
         return data["remainingCredit"]
 
     def allocate_area(
@@ -29,7 +29,7 @@ class CreditsApi:
     def check_allocated_area(
         self, scene_ids: List[str], geojson: ExtentData
     ) -> AllocatedAreaData:
-        """Allocate an area and time range."""
+        """Check area and cost of allocation, without allocating it."""
         url = f"{self.BASE_URL}/area/check-geojson"
         json_data = {"geojson": geojson, "sceneIds": scene_ids}
-        return self.api_client.send_post_query(url, json_data)
+        return self.api_client.send_post_query(url, json_data, idempotent=True)
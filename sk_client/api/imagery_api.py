@@ -1,5 +1,6 @@
 """SpaceKnow Ragnar API (Search Imagery)."""
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
 
 from ..types import InitiatedPipelineData, SearchImageryInitiateData, ImageMetadata
 
@@ -20,9 +21,39 @@ class ImageryApi:
         return self.api_client.send_post_query(url, search_data)
 
     def search_retrieve(self, pipeline_id: str) -> List[ImageMetadata]:
-        """Retrieve result of async search for imagery."""
+        """Retrieve result of async search for imagery, all its pages."""
+        return [
+            image_metadata
+            for page in self.search_retrieve_pages(pipeline_id)
+            for image_metadata in page
+        ]
+
+    def search_retrieve_pages(self, pipeline_id: str) -> Iterator[List[ImageMetadata]]:
+        """Retrieve result of async search for imagery page by page.
+
+        Next page is requested in background thread,
+        while current page is processed by caller.
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(self.__retrieve_page, pipeline_id)
+            while next_page is not None:
+                response_data = next_page.result()
+                cursor = response_data.get("cursor")
+                next_page = (
+                    executor.submit(self.__retrieve_page, pipeline_id, cursor)
+                    if cursor
+                    else None
+                )
+                yield response_data["results"]
+
+    def __retrieve_page(self, pipeline_id: str, cursor: Optional[str] = None) -> dict:
+        """Retrieve one page of result of async search for imagery.
+
+        :param cursor: Cursor of page from response with previous page,
+            None for first page
+        """
         url = f"{self.BASE_URL}/search/retrieve"
         json_data = {"pipelineId": pipeline_id}
-        response_data = self.api_client.send_post_query(url, json_data)
-        # todo(doubravskytomas): solve pagination
-        return response_data["results"]
+        if cursor is not None:
+            json_data["cursor"] = cursor
+        return self.api_client.send_post_query(url, json_data, idempotent=True)
@@ -4,16 +4,22 @@ The API interfaces imagery and analyses through tiled web map interface.
 """
 from typing import List
 from http import HTTPStatus
+import json
+import logging
 
 from requests import HTTPError
 
+from ..tiles import TileSet
 from ..types import ExtentData, KrakenAnalysisResultData, InitiatedPipelineData
 
+logger = logging.getLogger(__name__)
+
 
 class KrakenApi:
     """SpaceKnow Kraken API."""
 
     BASE_URL = "https://api.spaceknow.com/kraken"
+    __NOT_DOWNLOADED = object()
 
     def __init__(self, api_client):
         self.api_client = api_client
@@ -24,31 +30,112 @@ class KrakenApi:
         scene_ids: List[str],
         geojson: ExtentData,
     ) -> InitiatedPipelineData:
-        """Start analysis over selected area."""
+        """Start analysis over selected area.
+
+        Release store of API client (if set) is used first, stored release
+        is returned as resolved pipeline, when its result is stored too.
+        """
+        release_store = self.api_client.release_store
+        if release_store is not None:
+            pipeline_id = release_store.get_pipeline_id(map_type, scene_ids, geojson)
+            if pipeline_id is not None:
+                logger.info(f"Stored release of '{map_type}' used: {pipeline_id}.")
+                is_retrieved = release_store.get_result(pipeline_id) is not None
+                return {
+                    "pipelineId": pipeline_id,
+                    "status": "RESOLVED" if is_retrieved else "PROCESSING",
+                    "nextTry": 0,
+                }
         url = f"{self.BASE_URL}/release/initiate"
         json_data = {
             "mapType": map_type,
             "sceneIds": scene_ids,
             "extent": geojson,
         }
-        return self.api_client.send_post_query(url, json_data)
+        pipeline_data = self.api_client.send_post_query(url, json_data)
+        if release_store is not None:
+            release_store.put_pipeline(
+                map_type, scene_ids, geojson, pipeline_data["pipelineId"]
+            )
+        return pipeline_data
+
+    def is_release_stored(
+        self, map_type: str, scene_ids: List[str], geojson: ExtentData
+    ) -> bool:
+        """Return if release is in release store, so it is not released again."""
+        release_store = self.api_client.release_store
+        return (
+            release_store is not None
+            and release_store.get_pipeline_id(map_type, scene_ids, geojson) is not None
+        )
 
     def release_retrieve(self, pipeline_id: str) -> KrakenAnalysisResultData:
-        """Retrieve analysis data over selected area."""
-        url = f"{self.BASE_URL}/release/retrieve"
-        json_data = {"pipelineId": pipeline_id}
-        return self.api_client.send_post_query(url, json_data)
+        """Retrieve analysis data over selected area.
+
+        Release store of API client (if set) is used first,
+        retrieved data are saved into it.
+        """
+        release_store = self.api_client.release_store
+        result_data = None
+        if release_store is not None:
+            result_data = release_store.get_result(pipeline_id)
+        if result_data is None:
+            url = f"{self.BASE_URL}/release/retrieve"
+            json_data = {"pipelineId": pipeline_id}
+            result_data = self.api_client.send_post_query(
+                url, json_data, idempotent=True
+            )
+            if release_store is not None:
+                release_store.put_result(pipeline_id, result_data)
+        result_data["tiles"] = TileSet.from_list(result_data["tiles"])
+        return result_data
 
     def get_tile_data(self, map_id: str, z: int, x: int, y: int, file_name: str):
-        """Download one tile data for kraken run."""
+        """Download one tile data for kraken run.
+
+        Tile store of API client (if set) is used first,
+        downloaded tiles (also empty ones) are saved into it.
+
+        :return: Tile data or None for empty tile or tile, which failed
+            with permanent error (e.g. 404)
+        :raise requests.RequestException: Download failed with temporary
+            error (e.g. 503 or connection error) also after all retries
+        """
+        tile_store = self.api_client.tile_store
+        if tile_store is None:
+            tile_content = self.__download_tile_content(map_id, z, x, y, file_name)
+        else:
+            tile_key = (map_id, z, x, y, file_name)
+            try:
+                tile_content = tile_store.get(tile_key)
+            except KeyError:
+                tile_content = self.__download_tile_content(map_id, z, x, y, file_name)
+                if tile_content is not self.__NOT_DOWNLOADED:
+                    tile_store.put(tile_key, tile_content)
+        if tile_content is None or tile_content is self.__NOT_DOWNLOADED:
+            return None
+        if file_name in ["truecolor.png"]:
+            return tile_content
+        else:
+            return json.loads(tile_content)
+
+    def __download_tile_content(
+        self, map_id: str, z: int, x: int, y: int, file_name: str
+    ):  # pylint: disable=R0913
+        """Download raw content of one tile.
+
+        :return: Content of tile, None for empty tile
+            or __NOT_DOWNLOADED when download failed with permanent error
+        """
         url = f"{self.BASE_URL}/grid/{map_id}/-/{z}/{x}/{y}/{file_name}"
         try:
             response = self.api_client.send_get_query(url)
-        except HTTPError:
+        except HTTPError as error:
+            response = error.response
+            status_code = response.status_code if response is not None else None
+            if self.api_client.retry_policy.is_transient(status_code):
+                raise
+            return self.__NOT_DOWNLOADED
+        if response.status_code == HTTPStatus.NO_CONTENT or not response.content:
             return None
-        if response.status_code == HTTPStatus.NO_CONTENT:
-            return None
-        if file_name in ["truecolor.png"]:
-            return response.content
-        else:
-            return response.json()
+        return response.content
@@ -9,8 +9,13 @@ class TaskingApi:
     def __init__(self, api_client):
         self.api_client = api_client
 
-    def get_status(self, pipeline_id: str) -> float:
-        """Get pipeline status."""
+    def get_status(self, pipeline_id: str, retry: bool = True) -> float:
+        """Get pipeline status.
+
+        :param retry: If failed query is retried by API client
+        """
         url = f"{self.BASE_URL}/get-status"
         json_data = {"pipelineId": pipeline_id}
-        return self.api_client.send_post_query(url, json_data)
+        return self.api_client.send_post_query(
+            url, json_data, idempotent=True, retry=retry
+        )
@@ -12,4 +12,4 @@ class UserApi:
     def get_user_info(self) -> dict:
         """Get user info."""
         url = f"{self.BASE_URL}/info"
-        return self.api_client.send_post_query(url)
+        return self.api_client.send_post_query(url, idempotent=True)
@@ -1,10 +1,18 @@
 """Module with SpaceKnowClient to communicate with SpaceKnow API."""
 # pylint: disable=R0902
 import logging
+import threading
+import time
+from http import HTTPStatus
 from typing import Optional
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from . import settings
+from .release_store import ReleaseStore
+from .tile_store import TileStore
+from .throttling import AdaptiveRateLimiter, RetryPolicy, get_retry_after
 from .api import auth_api, user_api, credits_api, imagery_api, tasking_api, kraken_api
 
 
@@ -16,14 +24,41 @@ class SpaceKnowClient:
 
     It is wrapping all communication details like credentials, headers,
     managing request errors, ...
+
+    All API classes share one HTTP session, so connections are pooled
+    and kept alive between queries.
+
+    Queries of all threads are limited by one adaptive rate limiter,
+    failed queries are retried by retry policy (see throttling module).
     """
 
-    def __init__(self):
+    def __init__(self, download_workers: int = settings.TILE_DOWNLOAD_WORKERS):
         self.auth_id_token: Optional[str] = None
         self.number_of_queries: int = 0
-        self.headers = {
-            "Content-Type": "application/json",
-        }
+        self.__queries_lock = threading.Lock()
+        self.tile_store: Optional[TileStore] = None
+        self.release_store: Optional[ReleaseStore] = None
+        self.retry_policy = RetryPolicy(
+            settings.HTTP_MAX_RETRIES,
+            settings.HTTP_RETRY_BASE_DELAY,
+            settings.HTTP_RETRY_MAX_DELAY,
+        )
+        self.rate_limiter = AdaptiveRateLimiter(
+            settings.HTTP_MAX_RATE,
+            settings.HTTP_MIN_RATE,
+            settings.HTTP_RATE_INCREASE,
+            settings.HTTP_RATE_BURST,
+        )
+        self.session = requests.Session()
+        self.headers = self.session.headers
+        self.headers.update(
+            {
+                "Content-Type": "application/json",
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive",
+            }
+        )
+        self.configure_pool(download_workers)
         self.__init_api_classes()
 
     def __init_api_classes(self):
@@ -35,33 +70,109 @@ class SpaceKnowClient:
         self.tasking_api = tasking_api.TaskingApi(self)
         self.kraken_api = kraken_api.KrakenApi(self)
 
+    def configure_pool(self, download_workers: int):
+        """Set max number of kept-alive connections per host in session pool.
+
+        Pool is large enough for tiles downloaded by all concurrent stages,
+        so connections are not discarded and opened again.
+
+        :param download_workers: Number of concurrently downloaded tiles
+            by one stage
+        """
+        pool_size = (
+            settings.STAGE_WORKERS * download_workers + settings.HTTP_POOL_HEADROOM
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
     def set_auth_token(self, id_token: str):
         """Save auth id_token and add auth header."""
         self.auth_id_token = id_token
         self.headers["Authorization"] = f"Bearer {id_token}"
 
-    def send_post_query(self, url: str, json_data: Optional[dict] = None) -> dict:
-        """Send POST query."""
-        response = requests.post(url, json=json_data, headers=self.headers)
-        self.number_of_queries += 1
+    def __count_query(self):
+        """Increase number of sent queries, safe to call from more threads."""
+        with self.__queries_lock:
+            self.number_of_queries += 1
+
+    def send_post_query(
+        self,
+        url: str,
+        json_data: Optional[dict] = None,
+        idempotent: bool = False,
+        retry: bool = True,
+    ) -> dict:
+        """Send POST query.
+
+        :param idempotent: If query only reads data (e.g. status of pipeline),
+            so it is retried also after server and connection errors
+            (see RetryPolicy)
+        :param retry: If failed query is retried, False when caller retries it
+            by itself (e.g. PipelinePoller)
+        """
+        response = self.__send_query(
+            "POST", url, idempotent, retry=retry, json=json_data
+        )
         if not response.ok:
             logger.warning(
                 "Unable to get (POST) response for URL=%s, reason: %s",
                 url,
-                response.json(),
+                response.text,
             )
             response.raise_for_status()
         return response.json()
 
     def send_get_query(self, url: str) -> requests.Response:
         """Send GET query."""
-        response = requests.get(url, headers=self.headers)
-        self.number_of_queries += 1
+        response = self.__send_query("GET", url, True)
         if not response.ok:
             logger.warning(
                 "Unable to get (GET) response for URL=%s, reason: %s",
                 url,
-                response.json(),
+                response.text,
             )
             response.raise_for_status()
         return response
+
+    def __send_query(
+        self, method: str, url: str, idempotent: bool, retry: bool = True, **kwargs
+    ) -> requests.Response:
+        """Send query, when rate limiter allows it, retry it by retry policy.
+
+        :param idempotent: If query can be sent more times with the same effect
+        :param retry: If failed query is retried, otherwise it is sent once
+        :return: Response of last attempt
+        :raise requests.RequestException: Connection error of last attempt
+        """
+        max_retries = self.retry_policy.max_retries if retry else 0
+        attempt = 0
+        while True:
+            attempt += 1
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as error:
+                if attempt > max_retries or (
+                    not self.retry_policy.is_retryable_error(error, idempotent)
+                ):
+                    raise
+                logger.info(f"Query {method} {url} failed: {error!r}, retrying.")
+                time.sleep(self.retry_policy.get_delay(attempt))
+                continue
+            self.__count_query()
+            if response.status_code == HTTPStatus.TOO_MANY_REQUESTS:
+                self.rate_limiter.on_throttled(get_retry_after(response))
+            elif response.ok:
+                self.rate_limiter.on_success()
+            if attempt > max_retries or (
+                not self.retry_policy.is_retryable_status(
+                    response.status_code, idempotent
+                )
+            ):
+                return response
+            logger.info(
+                f"Query {method} {url} failed with status "
+                f"{response.status_code}, retrying."
+            )
+            time.sleep(self.retry_policy.get_delay(attempt, response))
@@ -0,0 +1,129 @@
+"""Module with estimation of cost of analyses of scenes.
+
+Cost of selected area is checked for each scene, which is not released yet,
+before anything is allocated, so analysis can be stopped,
+when total cost exceeds budget or remaining credits.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import typer
+
+from . import settings
+from .api_client import SpaceKnowClient
+from .data import RunningAnalysesData
+from .types import AllocatedAreaData, ExtentData
+
+
+def get_scenes_to_allocate(
+    api_client: SpaceKnowClient, scene_ids: List[str], selected_area: ExtentData
+) -> List[str]:
+    """Return scenes, for which 'cars' or 'imagery' release is not stored."""
+    return [
+        scene_id
+        for scene_id in scene_ids
+        if not all(
+            api_client.kraken_api.is_release_stored(map_type, [scene_id], selected_area)
+            for map_type in ("cars", "imagery")
+        )
+    ]
+
+
+def estimate_costs(
+    api_client: SpaceKnowClient,
+    ra_data: RunningAnalysesData,
+    scene_ids: List[str],
+    workers: int = settings.COST_ESTIMATE_WORKERS,
+) -> Dict[str, AllocatedAreaData]:
+    """Check area and cost of allocating selected area for each scene.
+
+    Area of all scenes is checked concurrently, nothing is allocated.
+    Area and cost of each scene and total are printed.
+
+    :param workers: Number of concurrently checked scenes
+    :return: Scene ID -> allocated area data
+    """
+    typer.echo(f"\n# Estimating cost of selected area, scenes: {len(scene_ids)}")
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            scene_id: executor.submit(
+                api_client.credits_api.check_allocated_area,
+                [scene_id],
+                ra_data.selected_area,
+            )
+            for scene_id in scene_ids
+        }
+        estimates = {scene_id: future.result() for scene_id, future in futures.items()}
+    for scene_id, estimate in estimates.items():
+        typer.echo(
+            f"   {ra_data.get_scene_title(scene_id)}: "
+            f"km2: {estimate['km2']}, cost: {estimate['cost']}"
+        )
+    typer.echo(f"--> km2: {sum(estimate['km2'] for estimate in estimates.values())}")
+    typer.echo(f"--> cost: {get_total_cost(estimates)}")
+    return estimates
+
+
+def get_total_cost(estimates: Dict[str, AllocatedAreaData]) -> float:
+    """Return total cost of estimates from estimate_costs."""
+    return sum(estimate["cost"] for estimate in estimates.values())
+
+
+def check_budget(
+    api_client: SpaceKnowClient,
+    estimates: Dict[str, AllocatedAreaData],
+    budget: Optional[float] = None,
+):
+    """Exit, when total cost exceeds budget or remaining credits of user.
+
+    :param estimates: Estimates from estimate_costs
+    :param budget: Max. total cost, None for no limit except remaining credits
+    """
+    total_cost = get_total_cost(estimates)
+    remaining_credit = api_client.credits_api.get_remaining_credit()
+    typer.echo(f"--> remaining credits: {remaining_credit}")
+    if budget is not None and total_cost > budget:
+        typer.echo(f"Total cost {total_cost} exceeds budget {budget}.", err=True)
+        raise typer.Exit(1)
+    if total_cost > remaining_credit:
+        typer.echo(
+            f"Total cost {total_cost} exceeds remaining credits {remaining_credit}.",
+            err=True,
+        )
+        raise typer.Exit(1)
+
+
+def limit_scene_pages_by_budget(
+    api_client: SpaceKnowClient,
+    ra_data: RunningAnalysesData,
+    scene_id_pages: Iterable[List[str]],
+    budget: Optional[float] = None,
+) -> Iterator[List[str]]:
+    """Yield pages of scenes, while total cost of their allocation fits budget.
+
+    Cost of scenes of each page is estimated by estimate_costs,
+    page exceeding budget (or remaining credits of user)
+    and all next pages are not yielded.
+
+    :param scene_id_pages: Pages of IDs of registered scenes
+    :param budget: Max. total cost, None for no limit except remaining credits
+    """
+    cost_limit = api_client.credits_api.get_remaining_credit()
+    if budget is not None:
+        cost_limit = min(cost_limit, budget)
+    total_cost = 0.0
+    for scene_ids in scene_id_pages:
+        estimates = estimate_costs(
+            api_client,
+            ra_data,
+            get_scenes_to_allocate(api_client, scene_ids, ra_data.selected_area),
+        )
+        total_cost += get_total_cost(estimates)
+        if total_cost > cost_limit:
+            typer.echo(
+                f"Total cost {total_cost} exceeds budget {cost_limit}, "
+                f"next scenes are not analysed.",
+                err=True,
+            )
+            return
+        yield scene_ids
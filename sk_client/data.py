@@ -1,8 +1,14 @@
 """Module with classes to hold data in the sk_client app."""
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
+import pickle
+import threading
 
 import typer
 
+from . import settings, utils
+from .detections import DetectionTable
+from .image_encoder import ImageEncoder
+from .tiles import TileSet
 from .types import ExtentData, InitiatedPipelineData, ImageMetadata
 
 
@@ -17,23 +23,122 @@ class RunningAnalysesData:  # pylint: disable=R0902
         self.scenes_index = {}  # scene_id -> index in scenes_list
         self.selected_area: Optional[ExtentData] = None
         self.selected_zoom = {}  # scene_id -> zoom level
+        # scene_id -> imagery tiles in selected zoom
+        self.imagery_tiles: Dict[str, TileSet] = {}
         self.selected_scenes = []
         self.cars_analysis_pipelines = []
         self.imagery_analysis_pipelines = []
         self.mapping_pipeline_to_scene_id = {}
         self.failed_scene_ids = set()
+        self.skipped_scene_ids = set()  # scenes skipped by user
         self.imagery_analysis_results = {}  # scene_id -> results
         self.cars_analysis_results = {}  # scene_id -> results
+        self.detections: Dict[str, DetectionTable] = {}  # scene_id -> detections
         self.detected_cars_count = 0
         self.detected_trucks_count = 0
-
-    def add_detected_car(self):
-        """Add one new detected car into stats."""
-        self.detected_cars_count += 1
-
-    def add_detected_truck(self):
-        """Add one new detected truck into stats."""
-        self.detected_trucks_count += 1
+        self.download_workers = settings.TILE_DOWNLOAD_WORKERS
+        self.out_of_core: Optional[bool] = None  # None - decide by imagery size
+        self.save_stitched_imagery = False
+        self.save_detection_geojson = False
+        self.image_workers = settings.IMAGE_PROCESS_WORKERS  # 0 - no processes
+        self.encoder = ImageEncoder(settings.OUTPUT_FORMAT, settings.OUTPUT_QUALITY)
+        self.tile_pyramid: Optional[str] = None  # None - one result image
+        self.batch_allocation = True  # allocate area of all scenes in one request
+        # download imagery in max. zoom, while user selects zoom level
+        self.prefetch_imagery = True
+        # scene_id -> name of done stage -> its result, see set_stage_done
+        self.done_stages: Dict[str, Dict[str, Any]] = {}
+        self.checkpoint_path: Optional[str] = None  # None - no checkpoints
+        self.resumed = False  # loaded from checkpoint, saved tiles are not downloaded
+        self.__stats_lock = threading.Lock()
+        self.__checkpoint_lock = threading.Lock()
+
+    def __getstate__(self):
+        """Return state for checkpoint, without locks and detections.
+
+        Detections are saved in binary detection tiles already,
+        they are loaded from them by load_checkpoint.
+        """
+        state = {
+            name: value.copy() if isinstance(value, (dict, list, set)) else value
+            for name, value in self.__dict__.items()
+        }
+        state["done_stages"] = {
+            scene_id: stages.copy() for scene_id, stages in self.done_stages.items()
+        }
+        state["detections"] = {}
+        del state["_RunningAnalysesData__stats_lock"]
+        del state["_RunningAnalysesData__checkpoint_lock"]
+        return state
+
+    def __setstate__(self, state):
+        """Restore data from checkpoint state, with new locks."""
+        self.__dict__.update(state)
+        self.__stats_lock = threading.Lock()
+        self.__checkpoint_lock = threading.Lock()
+
+    def set_stage_done(self, scene_id: str, stage_name: str, result: Any = None):
+        """Mark stage of scene as done, it is not run again on resume.
+
+        :param result: Result of stage, it has to be picklable
+        """
+        with self.__checkpoint_lock:
+            self.done_stages.setdefault(scene_id, {})[stage_name] = result
+
+    def unset_stage_done(self, scene_id: str, stage_name: str):
+        """Mark stage of scene as not done, so it is run again on resume."""
+        with self.__checkpoint_lock:
+            self.done_stages.get(scene_id, {}).pop(stage_name, None)
+
+    def is_stage_done(self, scene_id: str, stage_name: str) -> bool:
+        """Return if stage of scene is done (also in resumed run)."""
+        return stage_name in self.done_stages.get(scene_id, {})
+
+    def get_stage_result(self, scene_id: str, stage_name: str) -> Any:
+        """Return result of done stage of scene."""
+        return self.done_stages[scene_id][stage_name]
+
+    def save_checkpoint(self):
+        """Save data atomically into checkpoint_path, if it is set."""
+        if self.checkpoint_path is None:
+            return
+        with self.__checkpoint_lock:
+            state = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+            with utils.open_atomically(self.checkpoint_path) as file:
+                file.write(state)
+
+    @classmethod
+    def load_checkpoint(cls, path: str) -> "RunningAnalysesData":
+        """Load data saved by save_checkpoint.
+
+        Detections of scenes with downloaded detection tiles
+        are loaded from "result" folder.
+        Checkpoint is pickle, load only checkpoints saved by this app.
+
+        :raise FileNotFoundError: Checkpoint does not exist
+        """
+        with open(path, "rb") as file:
+            ra_data: RunningAnalysesData = pickle.load(file)
+        ra_data.checkpoint_path = path
+        ra_data.resumed = True
+        for scene_id in ra_data.selected_scenes:
+            if ra_data.is_stage_done(scene_id, "download-cars"):
+                detections = DetectionTable.load(
+                    ra_data.cars_analysis_results[scene_id]["tiles"], scene_id
+                )
+                detections.deduplicate()
+                ra_data.detections[scene_id] = detections
+        return ra_data
+
+    def add_detected_car(self, count: int = 1):
+        """Add new detected car(s) into stats."""
+        with self.__stats_lock:
+            self.detected_cars_count += count
+
+    def add_detected_truck(self, count: int = 1):
+        """Add new detected truck(s) into stats."""
+        with self.__stats_lock:
+            self.detected_trucks_count += count
 
     def get_scene_id(self, pipeline: InitiatedPipelineData) -> str:
         """Return scene ID by pipeline ID."""
@@ -46,19 +151,36 @@ class RunningAnalysesData:  # pylint: disable=R0902
     def print_stats(self):
         """Print statistics about finished analysis."""
         typer.echo(f"-> Scene processed: {len(self.selected_scenes)}")
-        successfully = len(self.selected_scenes) - len(self.failed_scene_ids)
+        successfully = (
+            len(self.selected_scenes)
+            - len(self.failed_scene_ids)
+            - len(self.skipped_scene_ids)
+        )
         typer.echo(f"--> successfully: {successfully}")
         typer.echo(f"--> unsuccessfully: {len(self.failed_scene_ids)}")
+        typer.echo(f"--> skipped: {len(self.skipped_scene_ids)}")
         detected_items_total = self.detected_cars_count + self.detected_trucks_count
         typer.echo(f"-> Detected items: {detected_items_total} total")
         typer.echo(f"--> cars: {self.detected_cars_count}")
         typer.echo(f"--> trucks: {self.detected_trucks_count}")
 
-    def register_scenes(self, list_imagery_data: List[ImageMetadata]):
-        """Register founded scenes/imagery."""
-        self.scenes_list = list_imagery_data
-        for index, imagery_data in enumerate(list_imagery_data):
-            self.scenes_index[imagery_data["sceneId"]] = index
+    def register_scenes(self, list_imagery_data: List[ImageMetadata]) -> List[str]:
+        """Register founded scenes/imagery, in addition to registered ones.
+
+        Already registered scenes are skipped, so scenes can be registered
+        page by page, as pages of search result are loaded.
+
+        :return: IDs of newly registered scenes
+        """
+        scene_ids = []
+        for imagery_data in list_imagery_data:
+            scene_id = imagery_data["sceneId"]
+            if scene_id in self.scenes_index:
+                continue
+            self.scenes_list.append(imagery_data)
+            self.scenes_index[scene_id] = len(self.scenes_list) - 1
+            scene_ids.append(scene_id)
+        return scene_ids
 
     def get_scene_data_by_id(self, scene_id: str) -> ImageMetadata:
         """Return scene/imagery data by sceneId."""
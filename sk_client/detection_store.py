@@ -0,0 +1,213 @@
+"""Module with persistent store of detected objects of all scenes."""
+from pathlib import Path
+from typing import List, NamedTuple, Optional
+import logging
+import sqlite3
+import threading
+
+import numpy as np
+
+from . import utils
+from .detections import DetectionTable, TileDetections
+from .types import ExtentData
+
+logger = logging.getLogger(__name__)
+
+
+class DetectedObject(NamedTuple):
+    """Detected object (or its fragment) returned by DetectionStore.query."""
+
+    detection_id: int
+    scene_id: str
+    datetime: str
+    feature_class: str
+    centroid_longitude: float
+    centroid_latitude: float
+    object_id: Optional[int]
+
+
+class DetectionStore:
+    """Persistent store of detected objects of all scenes and runs.
+
+    Objects are stored in one SQLite database, one row per object with columns:
+    scene ID, scene datetime, class, centroid, bounding box and polygon ring
+    (packed array of coordinates). Bounding boxes are indexed by R*Tree,
+    so spatial queries do not scan all objects.
+
+    Fragments of object split by tile border have own rows
+    with the same object ID (see DetectionTable.deduplicate).
+
+    Objects of scene are replaced, when the scene is analysed again.
+    """
+
+    def __init__(self, path: str):
+        """Open (or create) detection store.
+
+        :param path: Path to database file
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.executescript(
+            "CREATE TABLE IF NOT EXISTS detections ("
+            "id INTEGER PRIMARY KEY, scene_id TEXT NOT NULL, datetime TEXT, "
+            "class TEXT NOT NULL, centroid_longitude REAL, centroid_latitude REAL, "
+            "ring BLOB NOT NULL, object_id INTEGER);"
+            "CREATE INDEX IF NOT EXISTS detections_scene ON detections (scene_id);"
+            "CREATE VIRTUAL TABLE IF NOT EXISTS detections_index USING rtree("
+            "id, min_longitude, max_longitude, min_latitude, max_latitude);"
+        )
+        self.__connection.commit()
+
+    def add_scene(self, scene_id: str, datetime: str, detections: DetectionTable):
+        """Save all detected objects of scene, replace previously saved ones.
+
+        :param scene_id: ID of scene
+        :param datetime: Datetime of scene, e.g. "2018-01-05 00:12:45"
+        :param detections: Detected objects of scene
+        """
+        rows = []
+        for _, tile_detections in detections:
+            if len(tile_detections) > 0:
+                rows.extend(self.__get_rows(scene_id, datetime, tile_detections))
+        with self.__lock:
+            self.__remove_scene(scene_id)
+            for row in rows:
+                cursor = self.__connection.execute(
+                    "INSERT INTO detections (scene_id, datetime, class, "
+                    "centroid_longitude, centroid_latitude, ring, object_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    row[:7],
+                )
+                self.__connection.execute(
+                    "INSERT INTO detections_index VALUES (?, ?, ?, ?, ?)",
+                    (cursor.lastrowid, *row[7:]),
+                )
+            self.__connection.commit()
+        logger.info(f"Saved {len(rows)} detected objects of scene {scene_id}.")
+
+    @staticmethod
+    def __get_rows(scene_id: str, datetime: str, tile_detections: TileDetections):
+        """Return rows of objects from one detection tile.
+
+        :return: Rows in format [(scene ID, datetime, class, centroid longitude,
+            centroid latitude, ring, object ID, min longitude, max longitude,
+            min latitude, max latitude), ...]
+        """
+        coordinates = tile_detections.coordinates
+        starts = tile_detections.ring_offsets[:-1]
+        lengths = np.diff(tile_detections.ring_offsets)
+        centroids = np.add.reduceat(coordinates, starts) / lengths[:, np.newaxis]
+        minimums, maximums = tile_detections.get_bounding_boxes()
+        rings = tile_detections.get_rings(coordinates)
+        object_ids = tile_detections.object_ids
+        return [
+            (
+                scene_id,
+                datetime,
+                feature_class,
+                float(centroids[index][0]),
+                float(centroids[index][1]),
+                rings[index].tobytes(),
+                int(object_ids[index]) if object_ids is not None else None,
+                float(minimums[index][0]),
+                float(maximums[index][0]),
+                float(minimums[index][1]),
+                float(maximums[index][1]),
+            )
+            for index, feature_class in enumerate(tile_detections.classes)
+        ]
+
+    def __remove_scene(self, scene_id: str):
+        """Remove all objects of scene, lock has to be acquired."""
+        self.__connection.execute(
+            "DELETE FROM detections_index WHERE id IN "
+            "(SELECT id FROM detections WHERE scene_id=?)",
+            (scene_id,),
+        )
+        self.__connection.execute(
+            "DELETE FROM detections WHERE scene_id=?", (scene_id,)
+        )
+
+    def query(
+        self,
+        area: Optional[ExtentData] = None,
+        feature_class: Optional[str] = None,
+        start_datetime: Optional[str] = None,
+        end_datetime: Optional[str] = None,
+    ) -> List[DetectedObject]:
+        """Return objects matching all given filters.
+
+        :param area: GeoJSON, only objects with centroid inside it are returned
+        :param feature_class: Class of objects, e.g. "trucks"
+        :param start_datetime: Only objects from scenes taken at or after it
+        :param end_datetime: Only objects from scenes taken before it
+        :return: Objects matching filters
+        """
+        conditions = []
+        parameters = []
+        polygons = []
+        if area is not None:
+            polygons = utils.get_extent_polygons(area)
+            points = np.array([point[:2] for polygon in polygons for point in polygon])
+            conditions.append(
+                "id IN (SELECT id FROM detections_index WHERE "
+                "max_longitude >= ? AND min_longitude <= ? "
+                "AND max_latitude >= ? AND min_latitude <= ?)"
+            )
+            parameters.extend(
+                [
+                    points[:, 0].min(),
+                    points[:, 0].max(),
+                    points[:, 1].min(),
+                    points[:, 1].max(),
+                ]
+            )
+        if feature_class is not None:
+            conditions.append("class = ?")
+            parameters.append(feature_class)
+        if start_datetime is not None:
+            conditions.append("datetime >= ?")
+            parameters.append(start_datetime)
+        if end_datetime is not None:
+            conditions.append("datetime < ?")
+            parameters.append(end_datetime)
+        query = (
+            "SELECT id, scene_id, datetime, class, centroid_longitude, "
+            "centroid_latitude, object_id FROM detections"
+        )
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self.__lock:
+            rows = self.__connection.execute(query, parameters).fetchall()
+        objects = [DetectedObject(*row) for row in rows]
+        if polygons:
+            objects = [
+                detected_object
+                for detected_object in objects
+                if any(
+                    utils.is_point_in_polygon(
+                        detected_object.centroid_longitude,
+                        detected_object.centroid_latitude,
+                        polygon,
+                    )
+                    for polygon in polygons
+                )
+            ]
+        return objects
+
+    def get_ring(self, detection_id: int) -> np.ndarray:
+        """Return polygon ring of object in format [[longitude, latitude], ...]."""
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT ring FROM detections WHERE id=?", (detection_id,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(detection_id)
+        return np.frombuffer(row[0], dtype=np.float64).reshape(-1, 2)
+
+    def close(self):
+        """Close database connection."""
+        with self.__lock:
+            self.__connection.close()
@@ -0,0 +1,387 @@
+"""Module with in-memory table of detected objects."""
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+import itertools
+import struct
+import threading
+
+import numpy as np
+
+from . import settings, utils
+from .tiles import TileSet
+from .types import FeatureCollectionData
+
+
+class TileDetections:  # pylint: disable=R0903
+    """Detected objects from one detection tile, stored in columns.
+
+    Outer rings of all polygons are stored in one array of coordinates,
+    ring of i-th object is coordinates[ring_offsets[i]:ring_offsets[i + 1]].
+    Classes are stored as enum, class of i-th object is
+    class_names[class_codes[i]].
+
+    Tile detections are saved into binary file (see save), which is loaded
+    as memory-mapped arrays, without parsing and per-object allocation.
+    """
+
+    # binary file: header, class names separated by new line,
+    # padding to 8 bytes, ring offsets, coordinates, class codes
+    FILE_MAGIC = b"SKDT"
+    FILE_VERSION = 1
+    __FILE_HEADER = struct.Struct("<4sIIII")
+
+    def __init__(
+        self,
+        class_names: List[str],
+        class_codes: np.ndarray,
+        coordinates: np.ndarray,
+        ring_offsets: np.ndarray,
+    ):
+        self.class_names = class_names  # enum of classes, e.g. ["cars", "trucks"]
+        self.class_codes = class_codes  # index into class_names for each object
+        self.coordinates = coordinates  # [[longitude, latitude], ...]
+        self.ring_offsets = ring_offsets  # start of each ring, plus end of last one
+        # ID of object in scene, fragments of one object split by tile border
+        # have the same ID, set by DetectionTable.deduplicate
+        self.object_ids: Optional[np.ndarray] = None
+
+    def __len__(self):
+        """Return number of objects."""
+        return len(self.class_codes)
+
+    @property
+    def classes(self) -> List[str]:
+        """Return class of each object, e.g. "cars"."""
+        return [self.class_names[code] for code in self.class_codes.tolist()]
+
+    def get_class_mask(self, feature_class: str) -> np.ndarray:
+        """Return boolean mask of objects of given class."""
+        if feature_class not in self.class_names:
+            return np.zeros(len(self), dtype=bool)
+        return self.class_codes == self.class_names.index(feature_class)
+
+    @classmethod
+    def from_feature_collection(
+        cls, detection_tile_data: FeatureCollectionData
+    ) -> "TileDetections":
+        """Parse detection tile data (GeoJSON) into columns."""
+        class_names: List[str] = []
+        class_codes = []
+        rings = []
+        for feature in detection_tile_data["features"]:
+            ring = feature["geometry"]["coordinates"][0]
+            if not ring:
+                continue
+            feature_class = feature["properties"]["class"]
+            if feature_class not in class_names:
+                class_names.append(feature_class)
+            class_codes.append(class_names.index(feature_class))
+            rings.append(ring)
+        ring_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+        ring_offsets[1:] = np.cumsum([len(ring) for ring in rings])
+        coordinates = np.array(
+            [point[:2] for ring in rings for point in ring], dtype=np.float64
+        ).reshape(-1, 2)
+        return cls(
+            class_names,
+            np.array(class_codes, dtype=np.uint8),
+            coordinates,
+            ring_offsets,
+        )
+
+    def to_feature_collection(self) -> FeatureCollectionData:
+        """Export objects into GeoJSON with polygon feature for each object."""
+        rings = self.get_rings(self.coordinates)
+        return {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Polygon",
+                        "coordinates": [rings[index].tolist()],
+                    },
+                    "properties": {"class": feature_class},
+                }
+                for index, feature_class in enumerate(self.classes)
+            ],
+        }
+
+    def save(self, path: str):
+        """Save objects into binary file, see read."""
+        names = "\n".join(self.class_names).encode("utf-8")
+        header = self.__FILE_HEADER.pack(
+            self.FILE_MAGIC,
+            self.FILE_VERSION,
+            len(self),
+            len(self.coordinates),
+            len(names),
+        )
+        padding = b"\0" * (-(len(header) + len(names)) % 8)
+        with utils.open_atomically(path) as file:
+            file.write(header + names + padding)
+            file.write(np.ascontiguousarray(self.ring_offsets, dtype="<i8").tobytes())
+            file.write(np.ascontiguousarray(self.coordinates, dtype="<f8").tobytes())
+            file.write(np.ascontiguousarray(self.class_codes, dtype=np.uint8).tobytes())
+
+    @classmethod
+    def read(cls, path: str) -> "TileDetections":
+        """Load objects from binary file saved by save.
+
+        Arrays are memory-mapped, so only read parts of file are loaded.
+
+        :raise ValueError: File is not valid detections file
+        """
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        header_size = cls.__FILE_HEADER.size
+        (
+            magic,
+            version,
+            objects_count,
+            points_count,
+            names_size,
+        ) = cls.__FILE_HEADER.unpack(data[:header_size].tobytes())
+        if magic != cls.FILE_MAGIC or version != cls.FILE_VERSION:
+            raise ValueError(f"Unsupported detections file: {path}")
+        names_end = header_size + names_size
+        names = data[header_size:names_end].tobytes().decode("utf-8")
+        offsets_start = names_end + (-names_end % 8)
+        coordinates_start = offsets_start + 8 * (objects_count + 1)
+        codes_start = coordinates_start + 16 * points_count
+        codes_end = codes_start + objects_count
+        if len(data) != codes_end:
+            raise ValueError(f"Corrupted detections file: {path}")
+        return cls(
+            names.split("\n") if names else [],
+            data[codes_start:codes_end],
+            data[coordinates_start:codes_start].view("<f8").reshape(-1, 2),
+            data[offsets_start:coordinates_start].view("<i8"),
+        )
+
+    def get_rings(self, coordinates: np.ndarray) -> List[np.ndarray]:
+        """Split array with (converted) coordinates of all objects into rings."""
+        return np.split(coordinates, self.ring_offsets[1:-1])
+
+    def get_bounding_boxes(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return bounding boxes of all objects.
+
+        :return: Arrays of minimal and maximal coordinates of objects,
+            both in format [[longitude, latitude], ...]
+        """
+        starts = self.ring_offsets[:-1]
+        return (
+            np.minimum.reduceat(self.coordinates, starts),
+            np.maximum.reduceat(self.coordinates, starts),
+        )
+
+
+class DetectionTable:
+    """Table of detected objects of one scene.
+
+    Detection tiles are parsed once, when they are downloaded,
+    then the table is used for rendering and counting of detected objects.
+    Tiles can be added from more threads.
+    """
+
+    def __init__(self):
+        self.__tiles: Dict[Tuple[int, int, int], TileDetections] = {}
+        self.__lock = threading.Lock()
+
+    def __getstate__(self):
+        """Return state for pickling (e.g. for process pool), without lock."""
+        with self.__lock:
+            return dict(self.__tiles)
+
+    def __setstate__(self, state):
+        """Restore table from state of __getstate__, with new lock."""
+        self.__tiles = state
+        self.__lock = threading.Lock()
+
+    def __iter__(self) -> Iterator[Tuple[Tuple[int, int, int], TileDetections]]:
+        """Iterate over tiles in format ((z, x, y), tile detections)."""
+        with self.__lock:
+            return iter(list(self.__tiles.items()))
+
+    def __len__(self):
+        """Return number of objects of all tiles."""
+        with self.__lock:
+            return sum(
+                len(tile_detections) for tile_detections in self.__tiles.values()
+            )
+
+    @classmethod
+    def load(cls, tiles: TileSet, scene_id: str) -> "DetectionTable":
+        """Load table from detection tiles saved in "result" folder.
+
+        Binary detection tiles are used, GeoJSON detection tiles
+        are used only when binary ones are not saved (e.g. older results).
+        Not saved (empty) tiles are skipped.
+        """
+        detection_table = cls()
+        for tile in tiles:
+            try:
+                tile_detections = TileDetections.read(
+                    utils.get_detection_tile_path(scene_id, *tile)
+                )
+            except FileNotFoundError:
+                try:
+                    detection_tile_data = utils.load_detection_tile_data(
+                        *tile, scene_id
+                    )
+                except FileNotFoundError:
+                    continue
+                tile_detections = TileDetections.from_feature_collection(
+                    detection_tile_data
+                )
+            with detection_table.__lock:
+                detection_table.__tiles[tile] = tile_detections
+        return detection_table
+
+    def add_tile(
+        self, z: int, x: int, y: int, detection_tile_data: FeatureCollectionData
+    ) -> TileDetections:
+        """Parse detection tile data and add its objects into table.
+
+        :return: Parsed tile detections
+        """
+        tile_detections = TileDetections.from_feature_collection(detection_tile_data)
+        with self.__lock:
+            self.__tiles[(z, x, y)] = tile_detections
+        return tile_detections
+
+    def count(self, feature_class: str) -> int:
+        """Return number of objects of given class, e.g. "cars".
+
+        Fragments of one object (see deduplicate) are counted once.
+        """
+        object_ids = set()
+        fragments_count = 0
+        for _, tile_detections in self:
+            mask = tile_detections.get_class_mask(feature_class)
+            if tile_detections.object_ids is None:
+                fragments_count += int(np.count_nonzero(mask))
+            else:
+                object_ids.update(tile_detections.object_ids[mask].tolist())
+        return fragments_count + len(object_ids)
+
+    def deduplicate(self, tolerance: float = settings.DETECTION_MERGE_TOLERANCE) -> int:
+        """Find fragments of objects split by tile borders and give them one ID.
+
+        Object crossing tile border is detected in both tiles. Fragments
+        touching tile border are put into spatial hash grid by bounding boxes,
+        fragments of the same class from different tiles with overlapping
+        (or touching) bounding boxes are merged. Each fragment is compared only
+        with fragments in the same grid cells, so it takes linear time.
+
+        :param tolerance: Max. gap between merged fragments as fraction of tile size
+        :return: Number of merged fragments
+        """
+        tiles = list(self)
+        fragments = DisjointSet(sum(len(detections) for _, detections in tiles))
+        candidates = self.__get_border_fragments(tiles, tolerance)
+        merged_count = 0
+        if candidates:
+            cell_size = 2 * np.median(
+                [np.max(candidate[4] - candidate[3]) for candidate in candidates]
+            )
+            grid = defaultdict(list)
+            for candidate in candidates:
+                for cell in self.__get_grid_cells(candidate, cell_size):
+                    for other in grid[cell]:
+                        if self.__are_fragments_touching(candidate, other):
+                            merged_count += fragments.union(candidate[0], other[0])
+                    grid[cell].append(candidate)
+
+        offset = 0
+        for _, tile_detections in tiles:
+            tile_detections.object_ids = np.array(
+                [
+                    fragments.find(index)
+                    for index in range(offset, offset + len(tile_detections))
+                ],
+                dtype=np.int64,
+            )
+            offset += len(tile_detections)
+        return merged_count
+
+    @staticmethod
+    def __get_border_fragments(tiles, tolerance: float) -> list:
+        """Return fragments touching border of their tile.
+
+        :return: Fragments in format [(index of fragment, index of tile, class,
+            min. coordinates, max. coordinates), ...], bounding box of fragment
+            is enlarged by tolerance
+        """
+        fragments = []
+        offset = 0
+        for tile_index, (tile, tile_detections) in enumerate(tiles):
+            if len(tile_detections) == 0:
+                continue
+            west, south, east, north = utils.get_tile_bounds(*tile)
+            margin = (east - west) * tolerance
+            minimums, maximums = tile_detections.get_bounding_boxes()
+            minimums -= margin
+            maximums += margin
+            on_border = (
+                (minimums[:, 0] <= west)
+                | (maximums[:, 0] >= east)
+                | (minimums[:, 1] <= south)
+                | (maximums[:, 1] >= north)
+            )
+            fragments.extend(
+                (
+                    offset + index,
+                    tile_index,
+                    tile_detections.class_names[tile_detections.class_codes[index]],
+                    minimums[index],
+                    maximums[index],
+                )
+                for index in np.flatnonzero(on_border)
+            )
+            offset += len(tile_detections)
+        return fragments
+
+    @staticmethod
+    def __get_grid_cells(fragment, cell_size: float):
+        """Return cells of spatial hash grid covered by bounding box of fragment."""
+        cell_min = np.floor(fragment[3] / cell_size).astype(int)
+        cell_max = np.floor(fragment[4] / cell_size).astype(int)
+        return itertools.product(
+            range(cell_min[0], cell_max[0] + 1), range(cell_min[1], cell_max[1] + 1)
+        )
+
+    @staticmethod
+    def __are_fragments_touching(fragment, other_fragment) -> bool:
+        """Return if fragments from different tiles can be one object."""
+        return (
+            fragment[1] != other_fragment[1]
+            and fragment[2] == other_fragment[2]
+            and bool(np.all(fragment[3] <= other_fragment[4]))
+            and bool(np.all(other_fragment[3] <= fragment[4]))
+        )
+
+
+class DisjointSet:
+    """Disjoint set (union-find) of items numbered from 0."""
+
+    def __init__(self, items_count: int):
+        self.parents = np.arange(items_count)
+
+    def find(self, item: int) -> int:
+        """Return representative item of set containing item."""
+        while self.parents[item] != item:
+            self.parents[item] = self.parents[self.parents[item]]
+            item = self.parents[item]
+        return int(item)
+
+    def union(self, item: int, other_item: int) -> bool:
+        """Merge sets containing items.
+
+        :return: True if items were in different sets
+        """
+        root = self.find(item)
+        other_root = self.find(other_item)
+        if root == other_root:
+            return False
+        self.parents[root] = other_root
+        return True
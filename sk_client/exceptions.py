@@ -5,6 +5,14 @@ class ImproperlyConfiguredError(RuntimeError):
     """Raise when improperly configured project."""
 
 
+class SceneSkippedError(RuntimeError):
+    """Raise when user skipped scene, e.g. after seeing its preview."""
+
+
+class StageCancelledError(RuntimeError):
+    """Raise when running stage is cancelled, e.g. because its scene failed."""
+
+
 class PipelineFailedError(RuntimeError):
     """Raise when pipeline failed."""
 
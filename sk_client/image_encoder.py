@@ -0,0 +1,290 @@
+"""Module with encoders of output images."""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Deque, List, Optional, Tuple
+import logging
+import os
+import struct
+import threading
+import zlib
+
+import cv2
+import numpy as np
+
+from . import settings
+
+logger = logging.getLogger(__name__)
+
+
+class ImageEncoder:
+    """Encoder of output images (stitched imagery, result) in chosen format.
+
+    Formats:
+    - "png": lossless, quality is compression level 0-9 (default by OpenCV)
+    - "webp": lossless WebP, colors of fully transparent pixels are not kept
+    - "jpeg": lossy, without alpha channel, quality is 0-100 (default 95)
+    - "raw": NumPy array (.npy), no compression
+
+    Memory-mapped images are encoded into PNG strip by strip
+    (see write_png_by_strips), or copied into .npy file in "raw" format.
+    WebP and JPEG images are encoded by OpenCV at once and their size
+    is limited (see MAX_SIZES), so memory-mapped images and images bigger
+    than the limit are encoded into PNG strip by strip instead.
+
+    Images can be encoded in background threads shared by all encoders
+    (see submit), so encoding does not block thread preparing next image.
+    """
+
+    FORMATS = ("png", "webp", "jpeg", "raw")
+    # max. width and height of image in format (limits of libwebp and libjpeg)
+    MAX_SIZES = {"webp": 16383, "jpeg": 65535}
+    __EXTENSIONS = {"png": "png", "webp": "webp", "jpeg": "jpg", "raw": "npy"}
+    # quality above 100 selects lossless WebP in OpenCV
+    __WEBP_LOSSLESS_QUALITY = 101
+
+    __executor: Optional[ThreadPoolExecutor] = None
+    __executor_lock = threading.Lock()
+
+    def __init__(self, image_format: str = "png", quality: Optional[int] = None):
+        """Create encoder.
+
+        :param image_format: One of FORMATS
+        :param quality: Compression level (png) or quality (jpeg),
+            None for default of format
+        :raise ValueError: Unsupported format or quality
+        """
+        if image_format not in self.FORMATS:
+            raise ValueError(
+                f"Unsupported image format: {image_format}, "
+                f"supported are: {', '.join(self.FORMATS)}"
+            )
+        if quality is not None and image_format == "png" and not 0 <= quality <= 9:
+            raise ValueError("PNG compression level has to be from 0 to 9.")
+        if quality is not None and image_format == "jpeg" and not 0 <= quality <= 100:
+            raise ValueError("JPEG quality has to be from 0 to 100.")
+        self.image_format = image_format
+        self.quality = quality
+
+    @classmethod
+    def preview(cls) -> "ImageEncoder":
+        """Return encoder for interactive previews, where speed wins over size."""
+        return cls(settings.PREVIEW_FORMAT, settings.PREVIEW_QUALITY)
+
+    def __repr__(self):
+        """Return format and quality of encoder."""
+        return f"ImageEncoder({self.image_format!r}, quality={self.quality})"
+
+    @property
+    def extension(self) -> str:
+        """Return file extension of encoded images, without dot."""
+        return self.__EXTENSIONS[self.image_format]
+
+    @property
+    def is_streamed(self) -> bool:
+        """Return if memory-mapped images are encoded without loading into memory."""
+        return self.image_format in ("png", "raw")
+
+    def get_path(self, path_without_extension: str) -> str:
+        """Return path of encoded image, e.g. "result/scene/result.png"."""
+        return f"{path_without_extension}.{self.extension}"
+
+    def is_supported(self, image: np.ndarray) -> bool:
+        """Return if image can be encoded in format (see MAX_SIZES)."""
+        if isinstance(image, np.memmap) and not self.is_streamed:
+            return False
+        max_size = self.MAX_SIZES.get(self.image_format)
+        return max_size is None or max(image.shape[:2]) <= max_size
+
+    def write(self, image: np.ndarray, path_without_extension: str) -> str:
+        """Encode image in BGRA colors into file.
+
+        Image, which cannot be encoded in format (see is_supported),
+        is encoded into PNG strip by strip.
+
+        :param path_without_extension: Path of file without extension,
+            extension is given by format
+        :return: Path of written file
+        """
+        path = self.get_path(path_without_extension)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        if self.image_format == "raw":
+            np.save(path, image)
+        elif self.image_format == "png" and isinstance(image, np.memmap):
+            write_png_by_strips(
+                image,
+                path,
+                level=zlib.Z_DEFAULT_COMPRESSION
+                if self.quality is None
+                else self.quality,
+            )
+        elif not self.is_supported(image):
+            path = f"{path_without_extension}.png"
+            logger.warning(
+                f"Image of size {image.shape[1]}x{image.shape[0]} cannot be "
+                f"encoded into {self.image_format} at once, "
+                "it is encoded into PNG strip by strip."
+            )
+            write_png_by_strips(image, path)
+        elif not cv2.imwrite(path, image, self.__get_parameters()):
+            raise OSError(f"Unable to write image: {path}")
+        logger.info(f"Image encoded into {path}.")
+        return path
+
+    def encode(self, image: np.ndarray) -> bytes:
+        """Encode image in BGRA colors into bytes, e.g. for tile of tile pyramid.
+
+        :raise ValueError: Format is "raw"
+        """
+        if self.image_format == "raw":
+            raise ValueError("Raw format cannot be used for encoding into bytes.")
+        success, data = cv2.imencode(
+            f".{self.extension}", image, self.__get_parameters()
+        )
+        if not success:
+            raise ValueError(f"Unable to encode image into {self.image_format}.")
+        return data.tobytes()
+
+    def submit(self, image: np.ndarray, path_without_extension: str) -> Future:
+        """Encode image (see write) in background thread.
+
+        Image must not be changed till encoding is done.
+
+        :return: Future resolved with path of written file
+        """
+        return self.run_in_background(self.write, image, path_without_extension)
+
+    @classmethod
+    def run_in_background(cls, func: Callable[..., Any], *args) -> Future:
+        """Run encoding function in background thread shared by all encoders."""
+        return cls.__get_executor().submit(func, *args)
+
+    def __get_parameters(self) -> List[int]:
+        """Return OpenCV parameters of imwrite."""
+        if self.image_format == "webp":
+            return [cv2.IMWRITE_WEBP_QUALITY, self.__WEBP_LOSSLESS_QUALITY]
+        if self.quality is None:
+            return []
+        if self.image_format == "png":
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.quality]
+        return [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+
+    @classmethod
+    def __get_executor(cls) -> ThreadPoolExecutor:
+        """Return thread pool shared by all encoders, create it on first use."""
+        with cls.__executor_lock:
+            if cls.__executor is None:
+                cls.__executor = ThreadPoolExecutor(
+                    max_workers=settings.IMAGE_ENCODE_WORKERS,
+                    thread_name_prefix="encoder",
+                )
+            return cls.__executor
+
+    @classmethod
+    def reset_executor(cls):
+        """Forget shared thread pool, e.g. of parent process in forked process."""
+        cls.__executor = None
+        cls.__executor_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=ImageEncoder.reset_executor)
+
+
+def write_png_by_strips(
+    image: np.ndarray,
+    path: str,
+    strip_height: int = 0,
+    workers: int = settings.PNG_ENCODE_WORKERS,
+    level: int = zlib.Z_DEFAULT_COMPRESSION,
+):
+    """Write BGRA image into PNG file, encode it strip by strip.
+
+    Only few strips of image (at most `workers`) are in memory at time,
+    so it can be used for memory-mapped images bigger than memory.
+    Rows are encoded with PNG "Sub" filter.
+
+    Strips are filtered and compressed concurrently, each strip into own
+    deflate blocks ended by sync flush, so PNG file is the same
+    for any number of workers.
+
+    :param image: Image in BGRA colors
+    :param path: Path of PNG file
+    :param strip_height: Number of rows encoded at once,
+        default is settings.MOSAIC_STRIP_HEIGHT
+    :param workers: Number of concurrently compressed strips
+    :param level: Compression level from 0 to 9
+    """
+    strip_height = strip_height or settings.MOSAIC_STRIP_HEIGHT
+    height, width = image.shape[:2]
+
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + chunk_type
+            + data
+            + struct.pack(">I", zlib.crc32(chunk_type + data))
+        )
+
+    def encode_strip(strip_top: int) -> Tuple[bytes, int, int]:
+        strip_bottom = strip_top + strip_height
+        strip = cv2.cvtColor(
+            np.ascontiguousarray(image[strip_top:strip_bottom]),
+            cv2.COLOR_BGRA2RGBA,
+        )
+        # "Sub" filter: difference from pixel on the left (4 bytes per pixel)
+        filtered = strip.reshape(strip.shape[0], -1)
+        filtered[:, 4:] -= filtered[:, :-4].copy()
+        rows = np.empty((filtered.shape[0], filtered.shape[1] + 1), np.uint8)
+        rows[:, 0] = 1
+        rows[:, 1:] = filtered
+        # raw deflate, zlib header and checksum of whole image are written once
+        compressor = zlib.compressobj(level, wbits=-zlib.MAX_WBITS)
+        is_last = strip_bottom >= height
+        data = compressor.compress(rows) + compressor.flush(
+            zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH
+        )
+        return data, zlib.adler32(rows), rows.nbytes
+
+    with open(path, "wb") as file, ThreadPoolExecutor(max_workers=workers) as executor:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per channel, color type 6 (RGBA)
+        file.write(
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        )
+        # zlib header: deflate with 32K window and compression level
+        file.write(chunk(b"IDAT", zlib.compress(b"", level)[:2]))
+        checksum = zlib.adler32(b"")
+        pending: Deque[Future] = deque()
+
+        def write_strip(future: Future):
+            nonlocal checksum
+            data, strip_checksum, strip_size = future.result()
+            file.write(chunk(b"IDAT", data))
+            checksum = __combine_adler32(checksum, strip_checksum, strip_size)
+
+        for strip_top in range(0, height, strip_height):
+            pending.append(executor.submit(encode_strip, strip_top))
+            if len(pending) >= workers:
+                write_strip(pending.popleft())
+        while pending:
+            write_strip(pending.popleft())
+        file.write(chunk(b"IDAT", struct.pack(">I", checksum)))
+        file.write(chunk(b"IEND", b""))
+
+
+def __combine_adler32(checksum: int, other_checksum: int, other_size: int) -> int:
+    """Return Adler-32 checksum of concatenated data (as adler32_combine in zlib).
+
+    :param checksum: Checksum of first part of data
+    :param other_checksum: Checksum of second part of data
+    :param other_size: Size of second part of data in bytes
+    """
+    modulo = 65521
+    remainder = other_size % modulo
+    sum_a = checksum & 0xFFFF
+    sum_b = (remainder * sum_a) % modulo
+    sum_a = (sum_a + (other_checksum & 0xFFFF) + modulo - 1) % modulo
+    sum_b = (
+        sum_b + (checksum >> 16) + (other_checksum >> 16) + modulo - remainder
+    ) % modulo
+    return (sum_b << 16) | sum_a
@@ -1,122 +1,359 @@
 """Module for processing of loaded imagery tiles."""
-import logging
-import math
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from os.path import exists as file_exists
-from typing import List
-from collections import defaultdict
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+import logging
 
 import cv2
 import numpy as np
 
-from . import utils
+from . import settings, utils
+from .detections import DetectionTable
+from .image_encoder import ImageEncoder
+from .tile_pyramid import write_tile_pyramid
+from .tiles import TileSet
 
 logger = logging.getLogger(__name__)
 
 
-def __get_image_for_stitching(z, x, y, scene_id):
-    """Load image tile for stitching.
+TILE_SIZE = 256
 
-    Image is found in this order:
-    - imagery (imagery from API)
-    - empty img (white color) in resolution 256x256 px
-    """
-    path = f"result/{scene_id}/imagery-{z}-{x}-{y}.png"
-    if file_exists(path):
-        return cv2.imread(path, cv2.IMREAD_UNCHANGED)
-    logger.warning(
-        f"Tile for stitching not found, use empty image. "
-        f"Tile values: z={z}, x={x}, y={y}."
-    )
-    return np.zeros((256, 256, 4), dtype=np.uint8)
 
+# callable returning data of imagery tile (PNG) as get_tile_data(z, x, y),
+# None for tile, which was not downloaded
+TileDataGetter = Callable[[int, int, int], Optional[bytes]]
 
-def stitch_tiles(tiles: List[List[int]], scene_id: str):
+
+def __get_image_for_stitching(
+    z, x, y, get_tile_data: TileDataGetter
+) -> Optional[np.ndarray]:
+    """Load image tile for stitching in BGRA colors.
+
+    :return: Image or None, when tile was not downloaded
+    """
+    tile_data = get_tile_data(z, x, y)
+    if tile_data is None:
+        logger.warning(
+            f"Tile for stitching not found, use empty image. "
+            f"Tile values: z={z}, x={x}, y={y}."
+        )
+        return None
+    image = cv2.imdecode(np.frombuffer(tile_data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if image.ndim == 2:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGRA)
+    if image.shape[2] == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+    return image
+
+
+def stitch_tiles(  # pylint: disable=R0913
+    tiles: TileSet,
+    scene_id: str,
+    workers: int = settings.STITCH_WORKERS,
+    out_of_core: Optional[bool] = None,
+    save: bool = True,
+    encoder: Optional[ImageEncoder] = None,
+    get_tile_data: Optional[TileDataGetter] = None,
+) -> Optional[np.ndarray]:
     """Stitch all tiles into result image.
 
-    :param tiles: Tiles to process in format [[x, y, z], ...]
+    Result image (canvas) is allocated once, tiles are decoded concurrently
+    and each tile is copied into its place in canvas, in any order.
+
+    Out-of-core canvas is memory-mapped array saved in stitched-imagery.npy,
+    otherwise canvas is in memory and optionally saved into stitched-imagery
+    (e.g. stitched-imagery.png) by encoder.
+
+    Tiles do not have to form rectangle, e.g. when tiles outside of selected area
+    were not downloaded, missing tiles in bounding box are left empty.
+
+    :param tiles: Tiles to process
     :param scene_id: Scene ID, where tiles data come from
+    :param workers: Number of concurrently decoded tiles
+    :param out_of_core: If canvas is memory-mapped, None to decide by its size
+        (see settings.MOSAIC_IN_MEMORY_LIMIT)
+    :param save: If in-memory canvas is saved into stitched-imagery
+    :param encoder: Encoder of saved canvas, default is PNG encoder
+    :param get_tile_data: Getter of tile data, e.g. StoredTileReader,
+        default loads tiles saved in "result" folder
+    :return: Stitched imagery or None for no tiles
     """
     if len(tiles) == 0:
-        return
-    rows = defaultdict(list)
-    zoom = tiles[0][0]
-
-    # group tiles by rows
-    for tile in tiles:
-        rows[tile[2]].append(tile[1])
+        return None
+    min_x, min_y, max_x, max_y = tiles.bounding_box()
+    shape = ((max_y - min_y + 1) * TILE_SIZE, (max_x - min_x + 1) * TILE_SIZE, 4)
+    if out_of_core is None:
+        out_of_core = np.prod(shape) > settings.MOSAIC_IN_MEMORY_LIMIT
+    stitched_image = __create_canvas(shape, scene_id, out_of_core)
+    get_tile_data = get_tile_data or partial(utils.load_imagery_tile_data, scene_id)
+    __place_tiles(stitched_image, tiles, get_tile_data, workers)
+
+    if out_of_core:
+        stitched_image.flush()
+    elif save:
+        encoder = encoder or ImageEncoder()
+        encoder.write(stitched_image, f"result/{scene_id}/stitched-imagery")
+    return stitched_image
+
+
+def __place_tiles(
+    canvas: np.ndarray, tiles: TileSet, get_tile_data: TileDataGetter, workers: int
+):
+    """Decode tiles concurrently and copy each tile into its place in canvas."""
+    min_x, min_y, _, _ = tiles.bounding_box()
+
+    def place_tile(tile: Tuple[int, int, int]):
+        image = __get_image_for_stitching(*tile, get_tile_data)
+        if image is None:
+            return
+        top = (tile[2] - min_y) * TILE_SIZE
+        bottom = top + TILE_SIZE
+        left = (tile[1] - min_x) * TILE_SIZE
+        right = left + TILE_SIZE
+        canvas[top:bottom, left:right] = image
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(place_tile, tiles):
+            pass
+
+
+def render_preview(  # pylint: disable=R0913
+    detections: DetectionTable,
+    tiles: TileSet,
+    scene_id: str,
+    max_size: int = settings.PREVIEW_MAX_SIZE,
+    encoder: Optional[ImageEncoder] = None,
+    get_tile_data: Optional[TileDataGetter] = None,
+) -> Optional[str]:
+    """Render detected objects into small preview of imagery.
+
+    Tiles are stitched in memory, without saving stitched imagery,
+    result is downsampled to max_size and saved into "result" folder.
+
+    :param detections: Objects detected by 'cars' analysis
+    :param tiles: Imagery tiles in low (e.g. native) zoom
+    :param scene_id: ID of scene, where tiles data come from
+    :param max_size: Max. width and height of preview in pixels
+    :param encoder: Encoder of preview, default is ImageEncoder.preview()
+    :param get_tile_data: Getter of tile data, default loads tiles
+        saved in "result" folder
+    :return: Path of preview or None for no tiles
+    """
+    if len(tiles) == 0:
+        return None
+    min_x, min_y, max_x, max_y = tiles.bounding_box()
+    preview = np.zeros(
+        ((max_y - min_y + 1) * TILE_SIZE, (max_x - min_x + 1) * TILE_SIZE, 4),
+        dtype=np.uint8,
+    )
+    get_tile_data = get_tile_data or partial(utils.load_imagery_tile_data, scene_id)
+    __place_tiles(preview, tiles, get_tile_data, settings.STITCH_WORKERS)
+    render_polygons(
+        preview,
+        get_detected_polygons(detections, tiles.zoom, get_imagery_origin(tiles)),
+    )
+    scale = max_size / max(preview.shape[:2])
+    if scale < 1:
+        preview = cv2.resize(
+            preview, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+        )
+    encoder = encoder or ImageEncoder.preview()
+    return encoder.write(preview, f"result/{scene_id}/preview")
 
-    concatenated_row_images = []
-    for y in sorted(rows.keys()):
-        x_values = sorted(rows[y])
-        row_images = [__get_image_for_stitching(zoom, x, y, scene_id) for x in x_values]
-        concatenated_row_images.append(cv2.hconcat(row_images))
 
-    stitched_image = cv2.vconcat(concatenated_row_images)
+def __create_canvas(shape: Tuple[int, int, int], scene_id: str, out_of_core: bool):
+    """Create empty canvas for stitched imagery.
 
-    cv2.imwrite(f"result/{scene_id}/stitched-imagery.png", stitched_image)
+    Stitched imagery from previous run is removed, so rendering does not use it.
+    """
+    npy_path = Path(f"result/{scene_id}/stitched-imagery.npy")
+    npy_path.parent.mkdir(parents=True, exist_ok=True)
+    for path in npy_path.parent.glob("stitched-imagery.*"):
+        path.unlink()
+    if out_of_core:
+        return np.lib.format.open_memmap(
+            npy_path, mode="w+", dtype=np.uint8, shape=shape
+        )
+    return np.zeros(shape, dtype=np.uint8)
+
+
+def render_detected_objects(  # pylint: disable=R0913
+    detections: DetectionTable,
+    imagery_tiles: TileSet,
+    selected_zoom: int,
+    scene_id: str,
+    stitched_imagery: Optional[np.ndarray] = None,
+    encoder: Optional[ImageEncoder] = None,
+    tile_pyramid: Optional[str] = None,
+    keep_stitched: bool = True,
+) -> Optional[Future]:
+    """Render items from detections tiles into imagery tiles.
 
+    Stitched imagery is rendered in place and encoded into result image
+    (e.g. result.png) or into tile pyramid (e.g. result.mbtiles,
+    see tile_pyramid.write_tile_pyramid) in background thread.
+    When it is not given, it is loaded from files saved by stitch_tiles.
 
-def render_detected_objects(tiles: List[List[int]], selected_zoom: int, scene_id: str):
-    """Render items from detections tiles into imagery tiles.
+    Out-of-core stitched imagery (see stitch_tiles) is rendered
+    strip by strip, and result PNG image is encoded also strip by strip,
+    so whole imagery is never loaded in memory. Its file (stitched-imagery.npy)
+    is as big as uncompressed imagery, so it is removed after encoding,
+    unless it is kept.
 
-    :param tiles: Tiles from 'cars' analysis to process in format [[z, x, y], ...]
+    :param detections: Objects detected by 'cars' analysis
+    :param imagery_tiles: Tiles of stitched imagery
     :param selected_zoom: Zoom of stitched imagery
     :param scene_id: ID of scene, where objects were detected
+    :param stitched_imagery: Stitched imagery returned by stitch_tiles
+    :param encoder: Encoder of result image or tiles, default is PNG encoder
+    :param tile_pyramid: Format of tile pyramid written instead of result image,
+        one of tile_pyramid.PYRAMID_FORMATS, None for result image
+    :param keep_stitched: If out-of-core stitched imagery is kept after encoding
+    :return: Future resolved with path of result image (or tile pyramid),
+        when it is encoded, or None, when stitched imagery is not found
     """
-    stitched_imagery_path = f"result/{scene_id}/stitched-imagery.png"
-
-    if not file_exists(stitched_imagery_path):
+    if stitched_imagery is None:
+        stitched_imagery = load_stitched_imagery(scene_id)
+    if stitched_imagery is None:
         logger.warning(
             "Skipping detected objects rendering. "
-            f"Stitched imagery file not found: result/{scene_id}/stitched-imagery.png"
+            f"Stitched imagery file not found in: result/{scene_id}"
         )
-        return
-    stitched_imagery = cv2.imread(stitched_imagery_path, cv2.IMREAD_UNCHANGED)
+        return None
+    polygons = get_detected_polygons(
+        detections, selected_zoom, get_imagery_origin(imagery_tiles)
+    )
 
-    for tile in tiles:
-        stitched_imagery = render_detected_objects_into_imagery(
-            stitched_imagery, *tile, selected_zoom, scene_id
+    if isinstance(stitched_imagery, np.memmap):
+        __render_polygons_by_strips(stitched_imagery, polygons)
+    else:
+        render_polygons(stitched_imagery, polygons)
+    encoder = encoder or ImageEncoder()
+    if tile_pyramid is not None:
+        encode = partial(
+            write_tile_pyramid,
+            stitched_imagery,
+            imagery_tiles,
+            f"result/{scene_id}/result",
+            tile_pyramid,
+            encoder,
+        )
+    else:
+        encode = partial(encoder.write, stitched_imagery, f"result/{scene_id}/result")
+    if isinstance(stitched_imagery, np.memmap) and not keep_stitched:
+        return ImageEncoder.run_in_background(
+            __encode_and_remove_canvas, encode, scene_id
         )
+    return ImageEncoder.run_in_background(encode)
 
-    cv2.imwrite(f"result/{scene_id}/result.png", stitched_imagery)
 
+def __encode_and_remove_canvas(encode: Callable[[], str], scene_id: str) -> str:
+    """Encode rendered imagery and remove its out-of-core canvas file."""
+    path = encode()
+    Path(f"result/{scene_id}/stitched-imagery.npy").unlink(missing_ok=True)
+    logger.info(f"Out-of-core stitched imagery of scene {scene_id} removed.")
+    return path
 
-def render_detected_objects_into_imagery(
-    stitched_imagery, z, x, y, selected_zoom, scene_id
-):  # pylint: disable=R0913
-    """Render detected objects into imagery.
 
-    :param stitched_imagery: OpenCV imager with stitched imagery
-    :param z: Zoom of 'cars' analysis tiles
-    :param x: X coordinate of 'cars' analysis tile
-    :param y: Y coordinate of 'cars' analysis tile
-    :param selected_zoom: Selected zoom of stitched imagery
-    :param scene_id: ID of scene, where objects were detected
-    :return: OpenCV stitched imagery with rendered detected objects
-        from selected 'cars' analysis tile
+def load_stitched_imagery(scene_id: str) -> Optional[np.ndarray]:
+    """Load stitched imagery saved by stitch_tiles.
+
+    Out-of-core imagery is memory-mapped for reading and writing.
+
+    :return: Stitched imagery or None, when it is not saved
     """
-    try:
-        detection_geojson = utils.load_detection_tile_data(z, x, y, scene_id)
-    except FileNotFoundError:
-        logger.warning(
-            "Detection geojson file not found: "
-            f"result/{scene_id}/detections-{z}-{x}-{y}.geojson"
+    if file_exists(f"result/{scene_id}/stitched-imagery.npy"):
+        return np.load(f"result/{scene_id}/stitched-imagery.npy", mmap_mode="r+")
+    for extension in ("png", "webp", "jpg"):
+        path = f"result/{scene_id}/stitched-imagery.{extension}"
+        if file_exists(path):
+            image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+            if image.shape[2] == 3:
+                return cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+            return image
+    return None
+
+
+def __render_polygons_by_strips(stitched_imagery, polygons: List[np.ndarray]):
+    """Render polygons into memory-mapped imagery strip by strip.
+
+    Into each strip are rendered only polygons overlapping it.
+    """
+    if not polygons:
+        return
+    polygons_top = np.array([polygon[:, 1].min() for polygon in polygons])
+    polygons_bottom = np.array([polygon[:, 1].max() for polygon in polygons])
+    strip_height = settings.MOSAIC_STRIP_HEIGHT
+    for strip_top in range(0, stitched_imagery.shape[0], strip_height):
+        strip_bottom = min(strip_top + strip_height, stitched_imagery.shape[0])
+        overlapping = np.flatnonzero(
+            (polygons_bottom >= strip_top) & (polygons_top < strip_bottom)
+        )
+        render_polygons(
+            stitched_imagery[strip_top:strip_bottom],
+            [polygons[index] for index in overlapping],
+            offset=(0, -strip_top),
         )
-        return stitched_imagery
+        stitched_imagery.flush()
+
+
+def get_imagery_origin(imagery_tiles: TileSet) -> Tuple[int, int]:
+    """Return pixel coordinates of top left corner of stitched imagery.
+
+    Coordinates are in Web Mercator projection in zoom of imagery tiles,
+    see utils.convert_coordinates.
+    """
+    min_x, min_y, _, _ = imagery_tiles.bounding_box()
+    return min_x * 256, min_y * 256
+
 
+def render_polygons(
+    imagery: np.ndarray, polygons: List[np.ndarray], offset=(0, 0)
+) -> np.ndarray:
+    """Render (fill) all polygons into imagery in place.
+
+    Each polygon is filled by its own OpenCV call, polygons filled by one call
+    are filled by even-odd rule, so overlaps of objects would stay unfilled.
+
+    :param imagery: OpenCV imagery in BGRA colors
+    :param polygons: Polygons in format [array([[x, y], ...]), ...] (int32)
+    :param offset: Offset added to all polygons points
+    :return: Imagery with rendered polygons
+    """
     fill_color = (0, 255, 0, 255)  # color in BGRA
+    for polygon in polygons:
+        imagery = cv2.fillPoly(imagery, [polygon], fill_color, offset=offset)
+    return imagery
+
 
-    for feature in detection_geojson["features"]:
-        coordinates = feature["geometry"]["coordinates"][0]
-        points = get_coordinates_for_rendering(z, x, y, selected_zoom, coordinates)
-        pts = np.array(points, np.int32)
-        pts = pts.reshape((-1, 1, 2))
-        stitched_imagery = cv2.fillPoly(stitched_imagery, [pts], fill_color)
+def get_detected_polygons(
+    detections: DetectionTable, selected_zoom: int, origin
+) -> List[np.ndarray]:
+    """Return polygons of all detected objects.
 
-    return stitched_imagery
+    Coordinates of all polygons in one detection tile are converted at once.
 
+    :param detections: Objects detected by 'cars' analysis
+    :param selected_zoom: Selected zoom of stitched imagery
+    :param origin: Pixel coordinates of top left corner of stitched imagery
+    :return: Polygons in pixel coordinates of stitched imagery
+    """
+    polygons = []
+    for (z, x, y), tile_detections in detections:
+        if len(tile_detections) == 0:
+            continue
+        points = get_coordinates_for_rendering(
+            z, x, y, selected_zoom, tile_detections.coordinates, origin
+        )
+        polygons.extend(tile_detections.get_rings(points))
+    return polygons
 
-def get_coordinates_for_rendering(tile_z, tile_x, tile_y, selected_zoom, points):
+
+def get_coordinates_for_rendering(
+    tile_z, tile_x, tile_y, selected_zoom, points, origin
+):  # pylint: disable=R0913
     """Convert coordinates for rendering in one tile.
 
     Convert coordinates and ensure all points are inside tile,
@@ -129,31 +366,28 @@ def get_coordinates_for_rendering(tile_z, tile_x, tile_y, selected_zoom, points)
     We got selected_zoom - it is zoom level for stitched imagery tiles,
     and we got tile_z - it is zoom level per 'cars' analysis tile.
 
-    We stitched also 4 tiles on tile_z zoom level,
-    so we have to subtract 1 zoom level and recalculate tile x, y coordinates one level zoom out.
+    Converted coordinates are relative to origin - top left corner
+    of stitched imagery.
+
+    :param points: Array of points in format [[longitude, latitude], ...]
+    :return: Array of points in format [[x, y], ...] (int32)
     """
-    zoom_step = 2 ** (selected_zoom - tile_z + 1)
-    pixels_per_tile = 256 * zoom_step
-    tile_x = math.floor(tile_x / 2)
-    tile_y = math.floor(tile_y / 2)
+    pixels_per_tile = 256 * 2 ** (selected_zoom - tile_z)
 
     x_start = tile_x * pixels_per_tile
-    x_end = (tile_x + 1) * pixels_per_tile
     y_start = tile_y * pixels_per_tile
-    y_end = (tile_y + 1) * pixels_per_tile
-    converted_points = []
-    for point in points:
-        x, y = utils.convert_coordinates(point[0], point[1], selected_zoom)
-        if x < x_start:
-            x = x_start
-        elif x >= x_end:
-            x = x_end - 1
-        if y < y_start:
-            y = y_start
-        elif y >= y_end:
-            y = y_end - 1
-        x = x - (pixels_per_tile / 2)
-        y = y - (pixels_per_tile / 2)
-        converted_points.append([x % pixels_per_tile, y % pixels_per_tile])
-    return converted_points
-
+    converted_points = utils.convert_coordinates_array(points, selected_zoom)
+    np.clip(
+        converted_points[:, 0],
+        x_start,
+        x_start + pixels_per_tile - 1,
+        out=converted_points[:, 0],
+    )
+    np.clip(
+        converted_points[:, 1],
+        y_start,
+        y_start + pixels_per_tile - 1,
+        out=converted_points[:, 1],
+    )
+    converted_points -= origin
+    return converted_points.astype(np.int32)
@@ -0,0 +1,156 @@
+"""Module with poller, which watches many async pipelines at once."""
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from .types import InitiatedPipelineData, PipelineStatusData
+from .exceptions import PipelineFailedError
+
+logger = logging.getLogger(__name__)
+
+
+class PipelinePoller:
+    """Watch status of many async pipelines at once.
+
+    All watched pipelines are kept in one timer heap ordered by time
+    of the next status check, given by 'nextTry' from API.
+    One background thread checks the pipeline with the earliest time
+    and schedules its next check, so no pipeline is waiting for another one.
+    Status checks are not retried by API client, so one failing check
+    does not block checks of other pipelines. When status check fails
+    with temporary error (e.g. 503), next check is scheduled with backoff
+    of retry policy, pipeline fails after more such errors in a row.
+
+    Usage:
+        with PipelinePoller(api_client) as poller:
+            future = poller.watch(pipeline_data)
+            future.result()  # blocks till pipeline is resolved
+    """
+
+    def __init__(self, api_client):
+        self.api_client = api_client
+        # heap items: (time of next check, sequence, pipeline ID, future)
+        self.__heap: List[Tuple[float, int, str, Future]] = []
+        self.__sequence = itertools.count()
+        # pipeline ID -> number of status checks failed in a row
+        self.__failed_checks: Dict[str, int] = {}
+        self.__condition = threading.Condition()
+        self.__thread: Optional[threading.Thread] = None
+        self.__stopped = False
+
+    def __enter__(self):
+        """Return poller, it is stopped on exit."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop watching pipelines."""
+        self.stop()
+
+    def watch(self, pipeline_data: InitiatedPipelineData) -> Future:
+        """Start watching pipeline.
+
+        :return: Future resolved with last pipeline status, when pipeline
+            is resolved, or failed with PipelineFailedError, when pipeline failed.
+        """
+        future: Future = Future()
+        if not self.__handle_status(pipeline_data["pipelineId"], pipeline_data, future):
+            self.__schedule(pipeline_data["pipelineId"], pipeline_data, future)
+        return future
+
+    def stop(self):
+        """Stop background thread, not resolved pipelines are not watched anymore."""
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def __schedule(
+        self, pipeline_id: str, pipeline_status: PipelineStatusData, future: Future
+    ):
+        """Schedule next status check of pipeline."""
+        next_check = time.monotonic() + pipeline_status.get("nextTry", 0)
+        with self.__condition:
+            heapq.heappush(
+                self.__heap, (next_check, next(self.__sequence), pipeline_id, future)
+            )
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+            self.__condition.notify()
+
+    @staticmethod
+    def __handle_status(
+        pipeline_id: str, pipeline_status: PipelineStatusData, future: Future
+    ) -> bool:
+        """Resolve future by pipeline status.
+
+        :return: True if pipeline is finished (resolved or failed)
+        """
+        if pipeline_status["status"] == "RESOLVED":
+            future.set_result(pipeline_status)
+            return True
+        if pipeline_status["status"] == "FAILED":
+            future.set_exception(PipelineFailedError(pipeline_id=pipeline_id))
+            return True
+        return False
+
+    def __pop_next_pipeline(self) -> Optional[Tuple[str, Future]]:
+        """Wait till time of the earliest status check and pop its pipeline.
+
+        :return: Pipeline ID and its future, or None when poller is stopped
+        """
+        with self.__condition:
+            while not self.__stopped:
+                if not self.__heap:
+                    self.__condition.wait()
+                    continue
+                wait_time = self.__heap[0][0] - time.monotonic()
+                if wait_time <= 0:
+                    _, _, pipeline_id, future = heapq.heappop(self.__heap)
+                    return pipeline_id, future
+                self.__condition.wait(wait_time)
+            return None
+
+    def __run(self):
+        """Check status of pipelines in order given by timer heap."""
+        while True:
+            next_pipeline = self.__pop_next_pipeline()
+            if next_pipeline is None:
+                return
+            pipeline_id, future = next_pipeline
+            try:
+                pipeline_status = self.api_client.tasking_api.get_status(
+                    pipeline_id, retry=False
+                )
+            except Exception as error:  # pylint: disable=W0703
+                self.__handle_error(pipeline_id, error, future)
+                continue
+            self.__failed_checks.pop(pipeline_id, None)
+            if not self.__handle_status(pipeline_id, pipeline_status, future):
+                self.__schedule(pipeline_id, pipeline_status, future)
+
+    def __handle_error(self, pipeline_id: str, error: Exception, future: Future):
+        """Schedule next status check after temporary error, otherwise fail future."""
+        retry_policy = self.api_client.retry_policy
+        failed_checks = self.__failed_checks.get(pipeline_id, 0) + 1
+        if (
+            failed_checks > retry_policy.max_retries
+            or not retry_policy.is_transient_error(error)
+        ):
+            logger.warning(f"Unable to get status of pipeline {pipeline_id}.")
+            self.__failed_checks.pop(pipeline_id, None)
+            future.set_exception(error)
+            return
+        self.__failed_checks[pipeline_id] = failed_checks
+        response = getattr(error, "response", None)
+        delay = retry_policy.get_delay(failed_checks, response)
+        logger.info(
+            f"Status check of pipeline {pipeline_id} failed: {error!r}, "
+            f"next check in {delay:.1f}s."
+        )
+        self.__schedule(pipeline_id, {"nextTry": delay}, future)
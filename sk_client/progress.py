@@ -2,14 +2,25 @@
 
 Each step prints info into typer.echo output.
 """
-from typing import List, Optional
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from contextlib import nullcontext
+from functools import partial
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Optional
 from pathlib import Path
 import logging
+import multiprocessing
 import time
 
+import numpy as np
 import typer
 
-from . import utils, image_processing
+from . import settings, utils, image_processing
+from .costs import get_scenes_to_allocate
 from .types import (
     InitiatedPipelineData,
     ImageMetadata,
@@ -18,8 +29,16 @@ from .types import (
     KrakenAnalysisResultData,
 )
 from .api_client import SpaceKnowClient
-from .exceptions import PipelineFailedError
+from .polling import PipelinePoller
+from .scheduler import StageScheduler
+from .exceptions import PipelineFailedError, SceneSkippedError, StageCancelledError
 from .data import RunningAnalysesData
+from .detections import DetectionTable, TileDetections
+from .detection_store import DetectionStore
+from .image_encoder import ImageEncoder
+from .prompts import echo_progress, select_zoom_level
+from .tile_store import StoredTileReader
+from .tiles import TileSet
 
 logger = logging.getLogger(__name__)
 
@@ -77,48 +96,56 @@ def retrieve_imagery(
     return api_client.imagery_api.search_retrieve(pipeline_data["pipelineId"])
 
 
-def select_imagery(ra_data: RunningAnalysesData) -> Optional[int]:
-    """Ask user to select imagery.
-
-    :return: Index of selected imagery or None for all.
-    """
-    imagery_count = len(ra_data.scenes_list)
-    if imagery_count == 0:
-        typer.echo("No imagery found for selected area.")
-        raise typer.Exit(1)
+def search_scene_pages(
+    api_client: SpaceKnowClient, ra_data: RunningAnalysesData
+) -> Iterator[List[str]]:
+    """Search imagery in selected area and register found scenes page by page.
 
-    typer.echo("\n# Founded imagery:")
-    for index, scene_data in enumerate(ra_data.scenes_list):
-        scene_title = ra_data.get_scene_title(scene_data["sceneId"])
-        typer.echo(f"   {index}) {scene_title}")
+    Next page of search result is loaded in background,
+    while scenes of current page are processed.
 
-    while True:
-        selected_index: str = typer.prompt(
-            "> Select imagery for analysis, enter index above or 'all' for all imagery"
-        )
-        if selected_index == "all":
-            return None
-        if not selected_index.isdigit():
-            typer.echo("Invalid index, you have to insert number.")
-            continue
-        index = int(selected_index)
-        if not (0 <= index < imagery_count):  # pylint: disable=C0325
-            typer.echo(f"Invalid index, insert number >= 0 and < {imagery_count}.")
-            continue
-        return index
+    :return: Iterator of pages of IDs of newly registered scenes
+    """
+    search_pipeline = search_imagery(api_client, ra_data.selected_area)
+    wait_pipeline(api_client, search_pipeline)
+    typer.echo("\n# Retrieving imagery found in selected area, page by page.")
+    for page in api_client.imagery_api.search_retrieve_pages(
+        search_pipeline["pipelineId"]
+    ):
+        scene_ids = ra_data.register_scenes(page)
+        typer.echo(f"--> found scenes: {len(ra_data.scenes_list)}")
+        yield scene_ids
 
 
 def allocate_area(
-    api_client: SpaceKnowClient, scene_id: str, selected_area: ExtentData
+    api_client: SpaceKnowClient, scene_ids: List[str], selected_area: ExtentData
 ):
-    """Allocate selected area."""
-    typer.echo("\n# Allocating selected area")
-    analysis_data = {"scene_ids": [scene_id], "geojson": selected_area}
+    """Allocate selected area for all scenes in one request."""
+    typer.echo(f"\n# Allocating selected area, scenes: {len(scene_ids)}")
+    analysis_data = {"scene_ids": scene_ids, "geojson": selected_area}
     allocated_data = api_client.credits_api.allocate_area(**analysis_data)
     typer.echo(f"--> km2: {allocated_data['km2']}")
     typer.echo(f"--> cost: {allocated_data['cost']}")
 
 
+def allocate_area_for_releases(
+    api_client: SpaceKnowClient, scene_ids: List[str], selected_area: ExtentData
+):
+    """Allocate selected area for scenes without stored releases, in one request.
+
+    Stored 'cars' and 'imagery' releases (see KrakenApi.release_initiate)
+    are not released again, so area is not allocated for their scene again.
+    """
+    not_stored_scene_ids = get_scenes_to_allocate(api_client, scene_ids, selected_area)
+    if len(not_stored_scene_ids) < len(scene_ids):
+        typer.echo(
+            f"\n# Selected area is allocated for stored releases already, "
+            f"scenes: {len(scene_ids) - len(not_stored_scene_ids)}"
+        )
+    if not_stored_scene_ids:
+        allocate_area(api_client, not_stored_scene_ids, selected_area)
+
+
 def run_kraken_analysis_cars(
     api_client: SpaceKnowClient, scene_id: str, selected_area: ExtentData
 ) -> InitiatedPipelineData:
@@ -139,26 +166,64 @@ def retrieve_kraken_analysis_cars(
     return api_client.kraken_api.release_retrieve(pipeline_data["pipelineId"])
 
 
-def download_cars_analysis_tiles(
-    api_client: SpaceKnowClient, tiles: List[List[int]], map_id: str, scene_id: str
-) -> None:
-    """Download all 'cars' detection tiles."""
+def download_cars_analysis_tiles(  # pylint: disable=R0913
+    api_client: SpaceKnowClient,
+    tiles: TileSet,
+    map_id: str,
+    scene_id: str,
+    workers: int = settings.TILE_DOWNLOAD_WORKERS,
+    save_geojson: bool = False,
+    skip_existing: bool = False,
+) -> DetectionTable:
+    """Download all 'cars' detection tiles.
+
+    Each tile is parsed into table of detected objects and saved
+    into binary file, objects split by tile borders are merged.
+
+    :param save_geojson: If downloaded GeoJSON is also saved into 'result' folder
+    :param skip_existing: If tiles already saved in 'result' folder
+        (e.g. by interrupted run) are loaded instead of downloaded
+    """
     typer.echo("\n# Downloading kraken detection tiles for 'cars'.")
     typer.echo(f"--> map ID: {map_id}")
-    tile_count = len(tiles)
-    for tile_index, tile in enumerate(tiles):
-        typer.echo(
-            f"--> downloading tile ({tile_index + 1}/{tile_count}): "
-            f"{tile[0]}, {tile[1]}, {tile[2]}"
-        )
-        detection_tile_data = api_client.kraken_api.get_tile_data(
-            map_id, tile[0], tile[1], tile[2], "detections.geojson"
+    if skip_existing:
+        missing_tiles = get_missing_tiles(
+            tiles, partial(utils.get_detection_tile_path, scene_id)
         )
-        if detection_tile_data is None:
-            continue
+        detections = DetectionTable.load(tiles - missing_tiles, scene_id)
+        tiles = missing_tiles
+    else:
+        detections = DetectionTable()
+
+    def save_detection_tile(detection_tile_data, z: int, x: int, y: int):
+        tile_detections = detections.add_tile(z, x, y, detection_tile_data)
+        tile_detections.save(utils.get_detection_tile_path(scene_id, z, x, y))
+        if save_geojson:
+            utils.save_detection_tile_data(scene_id, detection_tile_data, z, x, y)
+
+    download_tiles(
+        api_client, tiles, map_id, "detections.geojson", save_detection_tile, workers
+    )
+    merged_count = detections.deduplicate()
+    typer.echo(f"--> merged fragments of objects split by tile border: {merged_count}")
+    return detections
+
+
+def export_detection_tiles(scene_id: str) -> int:
+    """Export binary detection tiles of scene into GeoJSON files.
+
+    GeoJSON file is saved next to each binary detection tile in 'result' folder.
+
+    :return: Number of exported tiles
+    """
+    paths = sorted(Path(f"result/{scene_id}").glob("detections-*-*-*.bin"))
+    for path in paths:
+        z, x, y = (int(value) for value in path.stem.split("-")[1:])
+        tile_detections = TileDetections.read(str(path))
         utils.save_detection_tile_data(
-            scene_id, detection_tile_data, tile[0], tile[1], tile[2]
+            scene_id, tile_detections.to_feature_collection(), z, x, y
         )
+    return len(paths)
 
 
 def run_kraken_analysis_imagery(
@@ -181,153 +246,697 @@ def retrieve_kraken_analysis_imagery(
     return api_client.kraken_api.release_retrieve(pipeline_data["pipelineId"])
 
 
-def download_imagery_analysis_tiles(
-    api_client: SpaceKnowClient, tiles: List[List[int]], map_id: str, scene_id: str
+def download_imagery_analysis_tiles(  # pylint: disable=R0913
+    api_client: SpaceKnowClient,
+    tiles: TileSet,
+    map_id: str,
+    scene_id: str,
+    workers: int = settings.TILE_DOWNLOAD_WORKERS,
+    is_cancelled: Optional[Callable[[], bool]] = None,
+    skip_existing: bool = False,
 ) -> None:
-    """Download all 'imagery' tiles."""
+    """Download all 'imagery' tiles.
+
+    Tiles are kept only in tile store of API client, when it is set
+    (see get_imagery_tile_reader), otherwise each tile is saved
+    into own file in 'result' folder.
+
+    :param is_cancelled: Callable returning True, when download is not needed
+    :param skip_existing: If tiles already saved in 'result' folder
+        (e.g. by interrupted run) are not downloaded again,
+        stored tiles are never downloaded again
+    """
     typer.echo("\n# Downloading kraken tiles for 'imagery'.")
     typer.echo(f"--> map ID: {map_id}")
+    if api_client.tile_store is not None:
+        save_tile = __skip_saving_tile
+    else:
+        save_tile = partial(utils.save_imagery_tile_data, scene_id)
+        if skip_existing:
+            tiles = get_missing_tiles(
+                tiles, partial(utils.get_imagery_tile_path, scene_id)
+            )
+    download_tiles(
+        api_client,
+        tiles,
+        map_id,
+        "truecolor.png",
+        save_tile,
+        workers,
+        is_cancelled,
+    )
+
+
+def __skip_saving_tile(*_):
+    """Do not save downloaded tile, it is kept in tile store."""
+
+
+def get_imagery_tile_reader(
+    api_client: SpaceKnowClient, map_id: str, scene_id: str
+) -> Callable[[int, int, int], Optional[bytes]]:
+    """Return getter of data of downloaded imagery tiles for stitching.
+
+    It can be pickled, so it can be passed into process pool.
+
+    :return: Reader of tile store of API client,
+        or loader of tiles saved in 'result' folder, when tile store is not set
+    """
+    if api_client.tile_store is not None:
+        return StoredTileReader(api_client.tile_store.path, map_id, "truecolor.png")
+    return partial(utils.load_imagery_tile_data, scene_id)
+
+
+def get_missing_tiles(tiles: TileSet, get_path: Callable[..., str]) -> TileSet:
+    """Return tiles, which are not saved yet.
+
+    :param get_path: Callable returning path of saved tile as get_path(z, x, y)
+    """
+    missing_tiles = tiles.filter(
+        [not Path(get_path(*tile)).is_file() for tile in tiles]
+    )
+    typer.echo(f"--> already saved tiles: {len(tiles) - len(missing_tiles)}")
+    return missing_tiles
+
+
+def download_tiles(  # pylint: disable=R0913
+    api_client: SpaceKnowClient,
+    tiles: TileSet,
+    map_id: str,
+    file_name: str,
+    save_tile: Callable[..., None],
+    workers: int,
+    is_cancelled: Optional[Callable[[], bool]] = None,
+) -> None:
+    """Download tiles concurrently, with at most `workers` requests in flight.
+
+    Each tile is saved by the worker thread, which downloaded it,
+    progress is printed in order in which tiles are finished.
+
+    :param tiles: Tiles to download
+    :param file_name: Name of requested file in Kraken grid, e.g. "truecolor.png"
+    :param save_tile: Callable called as save_tile(tile_data, z, x, y),
+        it is not called for empty tiles
+    :param workers: Number of concurrently downloaded tiles
+    :param is_cancelled: Callable returning True, when download is not needed
+        anymore (e.g. scene failed), not started tiles are not downloaded then
+    :raise StageCancelledError: Download was cancelled
+    :raise requests.RequestException: Tile failed with temporary error
+        also after all retries of API client, not started tiles
+        are not downloaded then, so failed tile is not left as hole in imagery
+    """
+
+    def download_tile(z: int, x: int, y: int) -> None:
+        tile_data = api_client.kraken_api.get_tile_data(map_id, z, x, y, file_name)
+        if tile_data is not None:
+            save_tile(tile_data, z, x, y)
+
     tile_count = len(tiles)
-    for tile_index, tile in enumerate(tiles):
-        typer.echo(
-            f"--> downloading tile ({tile_index + 1}/{tile_count}): "
-            f"{tile[0]}, {tile[1]}, {tile[2]}"
-        )
-        imagery_tile_data = api_client.kraken_api.get_tile_data(
-            map_id, tile[0], tile[1], tile[2], "truecolor.png"
-        )
-        if imagery_tile_data is None:
-            continue
-        utils.save_imagery_tile_data(
-            scene_id, imagery_tile_data, tile[0], tile[1], tile[2]
-        )
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(download_tile, *tile): tile for tile in tiles}
+
+        def cancel_not_started():
+            for not_finished_future in futures:
+                not_finished_future.cancel()
+
+        for tile_index, future in enumerate(as_completed(futures)):
+            if is_cancelled is not None and is_cancelled():
+                cancel_not_started()
+                raise StageCancelledError(
+                    f"Download cancelled after {tile_index} of {tile_count} tiles."
+                )
+            tile = futures[future]
+            if future.exception() is not None:
+                cancel_not_started()
+                logger.warning(f"Download of tile {tile} failed.")
+                raise future.exception()
+            echo_progress(
+                f"--> downloaded tile ({tile_index + 1}/{tile_count}): "
+                f"{tile[0]}, {tile[1]}, {tile[2]}"
+            )
+        typer.echo(f"--> downloaded tiles: {tile_count}")
 
 
-def render_detected_items_into_imageries(ra_data: RunningAnalysesData) -> None:
-    """Render detected items into imagery."""
-    for scene_id in ra_data.selected_scenes:
-        if ra_data.is_scene_failed(scene_id):
-            # Do not process imagery pipeline when 'cars' detection failed
-            continue
-        scene_title = ra_data.get_scene_title(scene_id)
-        typer.echo(
-            f"# Rendering detected objects into imagery tiles, scene: {scene_title}."
-        )
-        selected_zoom = ra_data.selected_zoom[scene_id]
-        image_processing.render_detected_objects(
-            ra_data.cars_analysis_results[scene_id]["tiles"], selected_zoom, scene_id
-        )
+def render_detected_items_into_imagery(
+    ra_data: RunningAnalysesData,
+    scene_id: str,
+    stitched_imagery: Optional[np.ndarray] = None,
+) -> Optional[Future]:
+    """Render detected items into imagery of one scene.
 
+    :param stitched_imagery: Stitched imagery from stitch_imageries,
+        None to load it from 'result' folder
+    :return: Future resolved, when result image is encoded
+    """
+    scene_title = ra_data.get_scene_title(scene_id)
+    typer.echo(
+        f"\n# Rendering detected objects into imagery tiles, scene: {scene_title}."
+    )
+    selected_zoom = ra_data.selected_zoom[scene_id]
+    return image_processing.render_detected_objects(
+        ra_data.detections[scene_id],
+        ra_data.imagery_tiles[scene_id],
+        selected_zoom,
+        scene_id,
+        stitched_imagery,
+        ra_data.encoder,
+        ra_data.tile_pyramid,
+        ra_data.save_stitched_imagery,
+    )
 
-def stitch_imageries(tiles: List[List[int]], scene_id: str) -> None:
-    """Stitch all imageries into final image."""
+
+def render_scene_preview(
+    api_client: SpaceKnowClient, ra_data: RunningAnalysesData, scene_id: str
+) -> Optional[str]:
+    """Render preview of scene from imagery tiles in native zoom.
+
+    Only few tiles in native zoom are downloaded, so preview is ready
+    in seconds, before user selects zoom of result imagery.
+
+    :return: Path of preview or None, when scene has no imagery tiles
+    """
+    typer.echo(f"\n# Rendering preview of scene: {ra_data.get_scene_title(scene_id)}.")
+    kraken_result_data = ra_data.imagery_analysis_results[scene_id]
+    tiles = kraken_result_data["tiles"]
+    tiles = utils.cover_tiles(tiles, tiles.zoom, ra_data.selected_area)
+    download_imagery_analysis_tiles(
+        api_client,
+        tiles,
+        kraken_result_data["mapId"],
+        scene_id,
+        ra_data.download_workers,
+        skip_existing=ra_data.resumed,
+    )
+    preview_path = image_processing.render_preview(
+        ra_data.detections[scene_id],
+        tiles,
+        scene_id,
+        get_tile_data=get_imagery_tile_reader(
+            api_client, kraken_result_data["mapId"], scene_id
+        ),
+    )
+    typer.echo(f"--> preview: {preview_path}")
+    return preview_path
+
+
+def stitch_imageries(  # pylint: disable=R0913
+    tiles: TileSet,
+    scene_id: str,
+    out_of_core: Optional[bool] = None,
+    save: bool = True,
+    encoder: Optional[ImageEncoder] = None,
+    get_tile_data: Optional[Callable[[int, int, int], Optional[bytes]]] = None,
+) -> Optional[np.ndarray]:
+    """Stitch all imageries into final image.
+
+    :param save: If stitched imagery is saved into 'result' folder
+    :param encoder: Encoder of saved stitched imagery
+    :param get_tile_data: Getter of tile data from get_imagery_tile_reader
+    :return: Stitched imagery
+    """
     typer.echo("\n# Stitching all enhanced imageries into final result.")
-    image_processing.stitch_tiles(tiles, scene_id)
+    return image_processing.stitch_tiles(
+        tiles,
+        scene_id,
+        out_of_core=out_of_core,
+        save=save,
+        encoder=encoder,
+        get_tile_data=get_tile_data,
+    )
 
 
-def run_analysis_pipelines(api_client: SpaceKnowClient, ra_data: RunningAnalysesData):
-    """Run all async pipelines at the same time for all selected scenes."""
-    for scene_id in ra_data.selected_scenes:
-        allocate_area(api_client, scene_id, ra_data.selected_area)
+def stitch_and_render_imagery(  # pylint: disable=R0913
+    imagery_tiles: TileSet,
+    detections: DetectionTable,
+    selected_zoom: int,
+    scene_id: str,
+    scene_title: str,
+    out_of_core: Optional[bool] = None,
+    save_stitched: bool = False,
+    encoder: Optional[ImageEncoder] = None,
+    tile_pyramid: Optional[str] = None,
+    get_tile_data: Optional[Callable[[int, int, int], Optional[bytes]]] = None,
+) -> None:
+    """Stitch imagery of one scene and render detected objects into it.
+
+    It does the same as stitch_imageries and render_detected_items_into_imagery,
+    but all arguments can be pickled, so it can run in process pool.
+    """
+    stitched_imagery = stitch_imageries(
+        imagery_tiles, scene_id, out_of_core, save_stitched, encoder, get_tile_data
+    )
+    typer.echo(
+        f"\n# Rendering detected objects into imagery tiles, scene: {scene_title}."
+    )
+    encoded = image_processing.render_detected_objects(
+        detections,
+        imagery_tiles,
+        selected_zoom,
+        scene_id,
+        stitched_imagery,
+        encoder,
+        tile_pyramid,
+        save_stitched,
+    )
+    if encoded is not None:
+        encoded.result()
+
+
+def create_image_executor(workers: int):
+    """Create process pool for image processing of scenes.
+
+    Processes are forked at once, before stage threads are started,
+    so no lock held by other thread is copied into them.
+
+    :param workers: Number of processes
+    :return: Process pool, or null context (None) for 0 workers
+        or when processes cannot be forked
+    """
+    if workers <= 0:
+        return nullcontext()
+    if "fork" not in multiprocessing.get_all_start_methods():
+        logger.warning("Processes cannot be forked, imagery is processed in threads.")
+        return nullcontext()
+    executor = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("fork")
+    )
+    executor.submit(int).result()
+    return executor
 
-        pipeline = run_kraken_analysis_cars(api_client, scene_id, ra_data.selected_area)
-        ra_data.mapping_pipeline_to_scene_id[pipeline["pipelineId"]] = scene_id
-        ra_data.cars_analysis_pipelines.append(pipeline)
 
-        pipeline = run_kraken_analysis_imagery(
-            api_client, scene_id, ra_data.selected_area
+def run_scenes_analyses(
+    api_client: SpaceKnowClient,
+    ra_data: RunningAnalysesData,
+    detection_store: Optional[DetectionStore] = None,
+    scene_id_pages: Iterable[List[str]] = (),
+):
+    """Run analyses for all selected scenes.
+
+    Analysis of each scene is graph of stages, stages of all scenes
+    run concurrently as soon as stages they depend on are done,
+    e.g. imagery tiles of one scene are downloaded while 'cars' pipeline
+    of other scene is still processing.
+    Pipelines of all scenes are watched at once by one poller.
+    Imagery of scenes is stitched and rendered in process pool
+    (see RunningAnalysesData.image_workers).
+
+    Scenes of scene_id_pages are selected and their stages are added,
+    as soon as each page is loaded, so analyses of first scenes run,
+    while next pages (e.g. of search result) are loaded.
+
+    With RunningAnalysesData.batch_allocation, selected area is allocated
+    for all scenes (of one page) in one request, before stages
+    of scenes are released.
+
+    After each done stage, analyses data are saved into checkpoint
+    (see RunningAnalysesData.checkpoint_path), done stages are not run again,
+    when analyses are resumed from checkpoint. Skipped scenes are not resumed.
+
+    :param detection_store: Store, where detected objects of scenes are saved
+    :param scene_id_pages: Pages of IDs of registered scenes, which are
+        analysed in addition to selected scenes, e.g. from search_scene_pages
+    """
+    # name of stage of more scenes -> IDs of its scenes
+    batch_scene_ids: Dict[str, List[str]] = {}
+
+    def on_stage_failure(stage_key, error: BaseException):
+        scene_id, stage_name = stage_key
+        if scene_id is None:
+            typer.echo(f"Stage '{stage_name}' of more scenes failed.", err=True)
+            ra_data.failed_scene_ids.update(
+                scene_id
+                for scene_id in batch_scene_ids[stage_name]
+                if not ra_data.is_stage_done(scene_id, "allocate")
+            )
+            return
+        if isinstance(error, SceneSkippedError):
+            typer.echo(f"Scene skipped: {ra_data.get_scene_title(scene_id)}.")
+            ra_data.skipped_scene_ids.add(scene_id)
+            ra_data.save_checkpoint()
+            return
+        if isinstance(error, PipelineFailedError):
+            typer.echo(f"Pipeline with id={error.pipeline_id} failed.", err=True)
+            if api_client.release_store is not None:
+                api_client.release_store.discard(error.pipeline_id)
+            # failed pipeline is released again, when analysis is resumed
+            map_type = stage_name.split("-", 1)[1]
+            ra_data.unset_stage_done(scene_id, f"release-{map_type}")
+            ra_data.unset_stage_done(scene_id, f"wait-{map_type}")
+        elif isinstance(error, StageCancelledError):
+            typer.echo(f"Stage '{stage_name}' cancelled, scene: {scene_id}.", err=True)
+        else:
+            typer.echo(f"Stage '{stage_name}' failed, scene: {scene_id}.", err=True)
+        ra_data.failed_scene_ids.add(scene_id)
+        ra_data.save_checkpoint()
+
+    def on_stage_done(stage_key, result):
+        scene_id, stage_name = stage_key
+        if scene_id is None or isinstance(result, np.ndarray):
+            # stages of all scenes are checkpointed by stages of each scene,
+            # stitched imagery is not checkpointed, it is stitched again on resume
+            return
+        ra_data.set_stage_done(scene_id, stage_name, result)
+        ra_data.save_checkpoint()
+
+    with create_image_executor(
+        ra_data.image_workers
+    ) as image_executor, ThreadPoolExecutor(
+        max_workers=1
+    ) as prompt_executor, PipelinePoller(
+        api_client
+    ) as poller, StageScheduler(
+        settings.STAGE_WORKERS, on_failure=on_stage_failure, on_done=on_stage_done
+    ) as scheduler:
+
+        def add_scenes(scene_ids: List[str]):
+            scene_ids = [
+                scene_id
+                for scene_id in scene_ids
+                if scene_id not in ra_data.skipped_scene_ids
+            ]
+            allocation_stage_key = None
+            if ra_data.batch_allocation:
+                allocation_stage_name = f"allocate-{len(batch_scene_ids)}"
+                batch_scene_ids[allocation_stage_name] = scene_ids
+                allocation_stage_key = add_allocation_stage(
+                    scheduler, api_client, ra_data, scene_ids, allocation_stage_name
+                )
+            for scene_id in scene_ids:
+                add_scene_stages(
+                    scheduler,
+                    poller,
+                    api_client,
+                    ra_data,
+                    scene_id,
+                    image_executor,
+                    allocation_stage_key,
+                    prompt_executor,
+                )
+                if detection_store is not None:
+                    scheduler.add_stage(
+                        (scene_id, "store-detections"),
+                        partial(
+                            store_detected_items, detection_store, ra_data, scene_id
+                        ),
+                        depends_on=[(scene_id, "download-cars")],
+                        group=scene_id,
+                    )
+
+        add_scenes(ra_data.selected_scenes)
+        for scene_ids in scene_id_pages:
+            ra_data.selected_scenes.extend(scene_ids)
+            add_scenes(scene_ids)
+        scheduler.join()
+
+
+def add_allocation_stage(
+    scheduler: StageScheduler,
+    api_client: SpaceKnowClient,
+    ra_data: RunningAnalysesData,
+    scene_ids: List[str],
+    stage_name: str = "allocate",
+) -> Optional[Hashable]:
+    """Add stage allocating selected area for all scenes in one request.
+
+    Scenes with done allocate stage (in resumed analysis) are not allocated.
+
+    :param stage_name: Unique name of stage
+    :return: Key of stage (scene ID of the key is None),
+        None when no scene has to be allocated
+    """
+    scene_ids = [
+        scene_id
+        for scene_id in scene_ids
+        if not ra_data.is_stage_done(scene_id, "allocate")
+    ]
+    if not scene_ids:
+        return None
+    stage_key = (None, stage_name)
+    scheduler.add_stage(
+        stage_key,
+        partial(
+            allocate_area_for_releases, api_client, scene_ids, ra_data.selected_area
+        ),
+    )
+    return stage_key
+
+
+def add_scene_stages(
+    scheduler: StageScheduler,
+    poller: PipelinePoller,
+    api_client: SpaceKnowClient,
+    ra_data: RunningAnalysesData,
+    scene_id: str,
+    image_executor: Optional[ProcessPoolExecutor] = None,
+    allocation_stage_key: Optional[Hashable] = None,
+    prompt_executor: Optional[ThreadPoolExecutor] = None,
+):  # pylint: disable=R0913,R0914,R0915
+    """Add graph of analysis stages of one scene into scheduler.
+
+    Graph of stages:
+        allocate -> release-cars -> wait-cars -> retrieve-cars -> download-cars
+        allocate -> release-imagery -> wait-imagery -> retrieve-imagery
+        retrieve-imagery, download-cars -> preview -> select-zoom
+        retrieve-imagery -> prefetch-imagery
+        select-zoom, prefetch-imagery -> download-imagery -> stitch
+        stitch, download-cars -> render
+        download-cars -> count
+
+    Area is not allocated, when both releases are in release store
+    of API client (see KrakenApi.release_initiate).
+    Preview of scene (native zoom imagery with detected objects) is rendered
+    before user selects zoom of imagery, user can skip the scene then.
+    User is prompted by thread of prompt executor, so stage workers are not
+    blocked and stages of other scenes run, while user decides.
+    Detected objects and imagery in max. zoom (offered as default zoom)
+    are downloaded already before user decides, see
+    RunningAnalysesData.prefetch_imagery. Prefetch is cancelled, when user
+    skips the scene or selects another zoom, tiles downloaded by prefetch
+    are not downloaded again.
+    Download of imagery is cancelled, when scene fails.
+
+    With process pool, stitched imagery is not passed between processes,
+    imagery is stitched and rendered by one render stage in pool process:
+        download-imagery, download-cars -> render
+
+    Stages already done in resumed analysis are not run again,
+    they return their checkpointed results.
+
+    :param image_executor: Process pool for stitching and rendering,
+        None to stitch and render in stage threads
+    :param allocation_stage_key: Key of stage allocating area for more scenes,
+        allocate stage of scene only waits for it, None to allocate area
+        of the scene by its allocate stage
+    :param prompt_executor: Executor with one thread prompting user,
+        None to prompt user in stage thread
+    """
+    area = ra_data.selected_area
+
+    def stage(name: str, func: Callable, depends_on=()):
+        if ra_data.is_stage_done(scene_id, name):
+            func = partial(ra_data.get_stage_result, scene_id, name)
+        scheduler.add_stage(
+            (scene_id, name),
+            func,
+            depends_on=[(scene_id, dependency) for dependency in depends_on],
+            group=scene_id,
         )
+
+    def release(run_kraken_analysis, pipelines):
+        pipeline = run_kraken_analysis(api_client, scene_id, area)
         ra_data.mapping_pipeline_to_scene_id[pipeline["pipelineId"]] = scene_id
-        ra_data.imagery_analysis_pipelines.append(pipeline)
+        pipelines.append(pipeline)
+        return pipeline
 
+    def wait_for(release_stage_name: str):
+        pipeline = scheduler.result((scene_id, release_stage_name))
+        typer.echo(f"... Waiting pipeline with ID: {pipeline['pipelineId']}.")
+        return poller.watch(pipeline)
 
-def process_cars_analysis_pipelines(
-    api_client: SpaceKnowClient, ra_data: RunningAnalysesData
-):
-    """Process all pipelines for 'cars' analyses."""
-    for pipeline in ra_data.cars_analysis_pipelines:
-        scene_id = ra_data.get_scene_id(pipeline)
-        try:
-            wait_pipeline(api_client, pipeline)
-        except PipelineFailedError:
-            ra_data.failed_scene_ids.add(scene_id)
-            continue
+    def retrieve_cars_analysis():
+        pipeline = scheduler.result((scene_id, "release-cars"))
         kraken_result_data = retrieve_kraken_analysis_cars(api_client, pipeline)
         ra_data.cars_analysis_results[scene_id] = kraken_result_data
-        download_cars_analysis_tiles(
+
+    def download_cars():
+        kraken_result_data = ra_data.cars_analysis_results[scene_id]
+        ra_data.detections[scene_id] = download_cars_analysis_tiles(
             api_client,
             kraken_result_data["tiles"],
             kraken_result_data["mapId"],
             scene_id,
+            ra_data.download_workers,
+            ra_data.save_detection_geojson,
+            ra_data.resumed,
         )
 
-
-def process_imagery_analysis_pipelines(
-    api_client: SpaceKnowClient, ra_data: RunningAnalysesData
-):
-    """Process all pipelines for 'imagery' analyses."""
-    for pipeline in ra_data.imagery_analysis_pipelines:
-        scene_id = ra_data.get_scene_id(pipeline)
-        if ra_data.is_scene_failed(scene_id):
-            # Do not process imagery pipeline when 'cars' detection failed
-            continue
-        try:
-            wait_pipeline(api_client, pipeline)
-        except PipelineFailedError:
-            ra_data.failed_scene_ids.add(scene_id)
-            continue
+    def retrieve_imagery_analysis():
+        pipeline = scheduler.result((scene_id, "release-imagery"))
         kraken_result_data = retrieve_kraken_analysis_imagery(api_client, pipeline)
+        ra_data.imagery_analysis_results[scene_id] = kraken_result_data
+
+    def select_zoom(preview_path: Optional[str]):
+        kraken_result_data = ra_data.imagery_analysis_results[scene_id]
         selected_zoom = select_zoom_level(
             scene_id,
             ra_data,
-            kraken_result_data["tiles"][0][0],
+            kraken_result_data["tiles"].zoom,
             kraken_result_data["maxZoom"],
+            preview_path,
+            kraken_result_data["maxZoom"] if ra_data.prefetch_imagery else None,
         )
-        zoomed_tiles = utils.zoom_tiles(kraken_result_data["tiles"], selected_zoom)
-        ra_data.imagery_analysis_results[scene_id] = kraken_result_data
+        if selected_zoom is None:
+            raise SceneSkippedError(scene_id)
         ra_data.selected_zoom[scene_id] = selected_zoom
+        ra_data.imagery_tiles[scene_id] = utils.cover_tiles(
+            kraken_result_data["tiles"], selected_zoom, area
+        )
+
+    def submit_select_zoom():
+        preview_path = scheduler.result((scene_id, "preview"))
+        if prompt_executor is None:
+            return select_zoom(preview_path)
+        return prompt_executor.submit(select_zoom, preview_path)
+
+    def prefetch_imagery():
+        kraken_result_data = ra_data.imagery_analysis_results[scene_id]
+        zoom = kraken_result_data["maxZoom"]
+
+        def is_cancelled():
+            return (
+                ra_data.is_scene_failed(scene_id)
+                or scene_id in ra_data.skipped_scene_ids
+                or ra_data.selected_zoom.get(scene_id, zoom) != zoom
+            )
+
+        try:
+            download_imagery_analysis_tiles(
+                api_client,
+                utils.cover_tiles(kraken_result_data["tiles"], zoom, area),
+                kraken_result_data["mapId"],
+                scene_id,
+                ra_data.download_workers,
+                is_cancelled,
+                ra_data.resumed,
+            )
+        except StageCancelledError as error:
+            # prefetch is not needed, scene is not failed
+            logger.info(f"Prefetch of imagery of scene {scene_id} stopped: {error}")
+
+    def get_tile_reader():
+        map_id = ra_data.imagery_analysis_results[scene_id]["mapId"]
+        return get_imagery_tile_reader(api_client, map_id, scene_id)
+
+    def download_imagery():
         download_imagery_analysis_tiles(
             api_client,
-            zoomed_tiles,
-            kraken_result_data["mapId"],
+            ra_data.imagery_tiles[scene_id],
+            ra_data.imagery_analysis_results[scene_id]["mapId"],
             scene_id,
+            ra_data.download_workers,
+            lambda: ra_data.is_scene_failed(scene_id),
+            ra_data.resumed or ra_data.prefetch_imagery,
         )
-        stitch_imageries(zoomed_tiles, scene_id)
 
-
-def select_zoom_level(
-    scene_id: str, ra_data: RunningAnalysesData, current_zoom_level, max_zoom_level
-) -> int:
-    """Allow user to select zoom level for result imagery."""
-    scene_title = ra_data.get_scene_title(scene_id)
-    while True:
-        selected_zoom_str: str = typer.prompt(
-            f"> Select zoom level for scene ({scene_title}), "
-            f"number from {current_zoom_level} to {max_zoom_level}"
+    if allocation_stage_key is None:
+        stage(
+            "allocate",
+            lambda: allocate_area_for_releases(api_client, [scene_id], area),
         )
-        if not selected_zoom_str.isdigit():
-            typer.echo("Invalid zoom level, you have to insert number.")
-            continue
-        selected_zoom = int(selected_zoom_str)
-        if not (
-            current_zoom_level <= selected_zoom <= max_zoom_level
-        ):  # pylint: disable=C0325
-            typer.echo(
-                f"Invalid zoom level, "
-                f"insert number >= {current_zoom_level} and <= {max_zoom_level}."
-            )
-            continue
-        return selected_zoom
-
-
-def count_detected_items(ra_data: RunningAnalysesData):
-    """Count detected items in imageries for all scenes."""
-    for scene_id, cars_analysis_results in ra_data.cars_analysis_results.items():
-        for tile in cars_analysis_results["tiles"]:
-            detection_geojson = utils.load_detection_tile_data(*tile, scene_id)
-            for feature in detection_geojson["features"]:
-                feature_class = feature["properties"]["class"]
-                if feature_class == "cars":
-                    ra_data.add_detected_car()
-                if feature_class == "trucks":
-                    ra_data.add_detected_truck()
+    else:
+        scheduler.add_stage(
+            (scene_id, "allocate"),
+            lambda: None,
+            depends_on=[allocation_stage_key],
+            group=scene_id,
+        )
+    stage(
+        "release-cars",
+        lambda: release(run_kraken_analysis_cars, ra_data.cars_analysis_pipelines),
+        depends_on=["allocate"],
+    )
+    stage(
+        "release-imagery",
+        lambda: release(
+            run_kraken_analysis_imagery, ra_data.imagery_analysis_pipelines
+        ),
+        depends_on=["allocate"],
+    )
+    stage("wait-cars", lambda: wait_for("release-cars"), ["release-cars"])
+    stage("wait-imagery", lambda: wait_for("release-imagery"), ["release-imagery"])
+    stage("retrieve-cars", retrieve_cars_analysis, ["wait-cars"])
+    stage("retrieve-imagery", retrieve_imagery_analysis, ["wait-imagery"])
+    stage("download-cars", download_cars, ["retrieve-cars"])
+    stage(
+        "preview",
+        lambda: render_scene_preview(api_client, ra_data, scene_id),
+        ["retrieve-imagery", "download-cars"],
+    )
+    stage("select-zoom", submit_select_zoom, ["preview"])
+    if ra_data.prefetch_imagery:
+        stage("prefetch-imagery", prefetch_imagery, ["retrieve-imagery"])
+        stage("download-imagery", download_imagery, ["select-zoom", "prefetch-imagery"])
+    else:
+        stage("download-imagery", download_imagery, ["select-zoom"])
+    if image_executor is None:
+        # stitched imagery is not checkpointed, it is not needed after render
+        stage(
+            "stitch",
+            lambda: None
+            if ra_data.is_stage_done(scene_id, "render")
+            else stitch_imageries(
+                ra_data.imagery_tiles[scene_id],
+                scene_id,
+                ra_data.out_of_core,
+                ra_data.save_stitched_imagery,
+                ra_data.encoder,
+                get_tile_reader(),
+            ),
+            ["download-imagery"],
+        )
+        stage(
+            "render",
+            lambda: render_detected_items_into_imagery(
+                ra_data, scene_id, scheduler.pop_result((scene_id, "stitch"))
+            ),
+            ["stitch", "download-cars"],
+        )
+    else:
+        stage(
+            "render",
+            lambda: image_executor.submit(
+                stitch_and_render_imagery,
+                ra_data.imagery_tiles[scene_id],
+                ra_data.detections[scene_id],
+                ra_data.selected_zoom[scene_id],
+                scene_id,
+                ra_data.get_scene_title(scene_id),
+                ra_data.out_of_core,
+                ra_data.save_stitched_imagery,
+                ra_data.encoder,
+                ra_data.tile_pyramid,
+                get_tile_reader(),
+            ),
+            ["download-imagery", "download-cars"],
+        )
+    stage(
+        "count",
+        lambda: count_detected_items(ra_data, scene_id),
+        ["download-cars"],
+    )
+
+
+def store_detected_items(
+    detection_store: DetectionStore, ra_data: RunningAnalysesData, scene_id: str
+):
+    """Save detected items of one scene into detection store."""
+    scene_data = ra_data.get_scene_data_by_id(scene_id)
+    detection_store.add_scene(
+        scene_id, scene_data["datetime"], ra_data.detections[scene_id]
+    )
+
+
+def count_detected_items(ra_data: RunningAnalysesData, scene_id: str):
+    """Count detected items in imagery of one scene."""
+    detections = ra_data.detections[scene_id]
+    ra_data.add_detected_car(detections.count("cars"))
+    ra_data.add_detected_truck(detections.count("trucks"))
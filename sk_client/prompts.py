@@ -0,0 +1,108 @@
+"""Module with prompts of user.
+
+Stages of more scenes run concurrently, but only one can prompt user at time.
+"""
+import threading
+from typing import Optional
+
+import typer
+
+from .data import RunningAnalysesData
+
+# Progress of stages is not printed, while the lock is held
+__prompt_lock = threading.Lock()
+
+
+def select_imagery(ra_data: RunningAnalysesData) -> Optional[int]:
+    """Ask user to select imagery.
+
+    :return: Index of selected imagery or None for all.
+    """
+    imagery_count = len(ra_data.scenes_list)
+    if imagery_count == 0:
+        typer.echo("No imagery found for selected area.")
+        raise typer.Exit(1)
+
+    typer.echo("\n# Founded imagery:")
+    for index, scene_data in enumerate(ra_data.scenes_list):
+        scene_title = ra_data.get_scene_title(scene_data["sceneId"])
+        typer.echo(f"   {index}) {scene_title}")
+
+    while True:
+        selected_index: str = typer.prompt(
+            "> Select imagery for analysis, enter index above or 'all' for all imagery"
+        )
+        if selected_index == "all":
+            return None
+        if not selected_index.isdigit():
+            typer.echo("Invalid index, you have to insert number.")
+            continue
+        index = int(selected_index)
+        if not (0 <= index < imagery_count):  # pylint: disable=C0325
+            typer.echo(f"Invalid index, insert number >= 0 and < {imagery_count}.")
+            continue
+        return index
+
+
+def echo_progress(message: str):
+    """Print progress message, unless user is prompted, so prompt is not overwritten.
+
+    Progress messages are only informative, so they are dropped during prompt.
+    """
+    if not __prompt_lock.locked():
+        typer.echo(message)
+
+
+def select_zoom_level(  # pylint: disable=R0913
+    scene_id: str,
+    ra_data: RunningAnalysesData,
+    current_zoom_level,
+    max_zoom_level,
+    preview_path: Optional[str] = None,
+    default_zoom_level: Optional[int] = None,
+) -> Optional[int]:
+    """Allow user to select zoom level for result imagery or skip the scene.
+
+    :param preview_path: Path of scene preview shown to user
+    :param default_zoom_level: Zoom level selected by empty input,
+        e.g. zoom of prefetched imagery, None - no default
+    :return: Selected zoom level or None, when user skipped the scene
+    """
+    scene_title = ra_data.get_scene_title(scene_id)
+    if preview_path is not None:
+        scene_title = f"{scene_title}, preview: {preview_path}"
+    with __prompt_lock:
+        return __prompt_zoom_level(
+            scene_title, current_zoom_level, max_zoom_level, default_zoom_level
+        )
+
+
+def __prompt_zoom_level(
+    scene_title: str,
+    current_zoom_level,
+    max_zoom_level,
+    default_zoom_level: Optional[int] = None,
+) -> Optional[int]:
+    """Prompt user for zoom level till valid zoom level or 'skip' is entered."""
+    while True:
+        selected_zoom_str: str = typer.prompt(
+            f"> Select zoom level for scene ({scene_title}), "
+            f"number from {current_zoom_level} to {max_zoom_level}, "
+            f"or 'skip' to skip the scene",
+            default=None if default_zoom_level is None else str(default_zoom_level),
+        )
+        if selected_zoom_str.strip().lower() == "skip":
+            return None
+        if not selected_zoom_str.isdigit():
+            typer.echo("Invalid zoom level, you have to insert number.")
+            continue
+        selected_zoom = int(selected_zoom_str)
+        if not (
+            current_zoom_level <= selected_zoom <= max_zoom_level
+        ):  # pylint: disable=C0325
+            typer.echo(
+                f"Invalid zoom level, "
+                f"insert number >= {current_zoom_level} and <= {max_zoom_level}."
+            )
+            continue
+        return selected_zoom
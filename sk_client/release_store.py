@@ -0,0 +1,118 @@
+"""Module with persistent store of Kraken releases."""
+from pathlib import Path
+from typing import List, Optional
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from .types import ExtentData
+
+logger = logging.getLogger(__name__)
+
+
+class ReleaseStore:
+    """Persistent store of Kraken releases (pipelines and their results).
+
+    Each release is keyed by (mapType, sceneIds, hash of extent),
+    so repeated analysis of the same area and scene reuses its pipeline
+    and retrieved result (mapId, tiles) instead of releasing it again.
+    Releases older than time to live are not used.
+    Store can be used from more threads.
+    """
+
+    def __init__(self, path: str, ttl: float):
+        """Open (or create) release store.
+
+        :param path: Path to database file
+        :param ttl: Time to live of stored releases in seconds
+        """
+        self.ttl = ttl
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS releases ("
+            "map_type TEXT, scene_ids TEXT, extent_hash TEXT, "
+            "pipeline_id TEXT NOT NULL, result TEXT, created REAL NOT NULL, "
+            "PRIMARY KEY (map_type, scene_ids, extent_hash))"
+        )
+        self.__connection.execute(
+            "CREATE INDEX IF NOT EXISTS releases_pipeline_id "
+            "ON releases (pipeline_id)"
+        )
+        self.__connection.commit()
+
+    @staticmethod
+    def get_extent_hash(extent: ExtentData) -> str:
+        """Return hash of extent, which does not depend on order of keys."""
+        canonical_json = json.dumps(extent, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical_json.encode("utf-8")).hexdigest()
+
+    def get_pipeline_id(
+        self, map_type: str, scene_ids: List[str], extent: ExtentData
+    ) -> Optional[str]:
+        """Return ID of stored pipeline of release, None when it is not stored.
+
+        Expired releases are deleted.
+        """
+        key = (map_type, ",".join(scene_ids), self.get_extent_hash(extent))
+        with self.__lock:
+            self.__connection.execute(
+                "DELETE FROM releases WHERE created<?", (time.time() - self.ttl,)
+            )
+            self.__connection.commit()
+            row = self.__connection.execute(
+                "SELECT pipeline_id FROM releases "
+                "WHERE map_type=? AND scene_ids=? AND extent_hash=?",
+                key,
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def put_pipeline(
+        self, map_type: str, scene_ids: List[str], extent: ExtentData, pipeline_id: str
+    ):
+        """Store pipeline of new release, its result is not known yet."""
+        key = (map_type, ",".join(scene_ids), self.get_extent_hash(extent))
+        with self.__lock:
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO releases VALUES (?, ?, ?, ?, NULL, ?)",
+                (*key, pipeline_id, time.time()),
+            )
+            self.__connection.commit()
+
+    def get_result(self, pipeline_id: str) -> Optional[dict]:
+        """Return stored result of release pipeline, None when it is not stored."""
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT result FROM releases WHERE pipeline_id=? AND created>=?",
+                (pipeline_id, time.time() - self.ttl),
+            ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def put_result(self, pipeline_id: str, result: dict):
+        """Store result (JSON data) of release pipeline."""
+        with self.__lock:
+            self.__connection.execute(
+                "UPDATE releases SET result=? WHERE pipeline_id=?",
+                (json.dumps(result), pipeline_id),
+            )
+            self.__connection.commit()
+
+    def discard(self, pipeline_id: str):
+        """Delete release of pipeline, e.g. when pipeline failed."""
+        with self.__lock:
+            self.__connection.execute(
+                "DELETE FROM releases WHERE pipeline_id=?", (pipeline_id,)
+            )
+            self.__connection.commit()
+        logger.info(f"Release of pipeline {pipeline_id} discarded from store.")
+
+    def close(self):
+        """Close database connection."""
+        with self.__lock:
+            self.__connection.close()
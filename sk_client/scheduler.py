@@ -0,0 +1,223 @@
+"""Module with scheduler running graph of analysis stages."""
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:  # pylint: disable=R0903
+    """One stage in graph of stages."""
+
+    PENDING = "PENDING"
+    RUNNING = "RUNNING"
+    DONE = "DONE"
+    FAILED = "FAILED"
+    SKIPPED = "SKIPPED"
+
+    def __init__(
+        self,
+        key: Hashable,
+        func: Callable[[], Any],
+        depends_on: Set[Hashable],
+        group: Optional[Hashable],
+    ):
+        self.key = key
+        self.func = func
+        self.group = group
+        self.waiting_for = set(depends_on)  # keys of not finished dependencies
+        self.status = self.PENDING
+        self.result: Any = None
+
+
+class StageScheduler:  # pylint: disable=R0902
+    """Run stages concurrently, each stage as soon as all its dependencies are done.
+
+    Stage is a callable without arguments, identified by unique key.
+    When stage returns Future (e.g. from PipelinePoller), stage is done
+    when the future is done, without blocking any worker thread.
+
+    Stages can be put into group (e.g. all stages of one scene).
+    When stage fails, all not started stages of its group
+    and all stages depending on them are skipped.
+
+    Usage:
+        with StageScheduler(workers=4) as scheduler:
+            scheduler.add_stage("download", download)
+            scheduler.add_stage("stitch", stitch, depends_on=["download"])
+            scheduler.join()
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        on_failure: Optional[Callable[[Hashable, BaseException], None]] = None,
+        on_done: Optional[Callable[[Hashable, Any], None]] = None,
+    ):
+        """Create scheduler.
+
+        :param workers: Number of stages running at the same time
+        :param on_failure: Callable called as on_failure(stage_key, error),
+            when stage fails
+        :param on_done: Callable called as on_done(stage_key, result),
+            when stage is done, before stages depending on it are started,
+            stage fails, when it raises exception
+        """
+        self.on_failure = on_failure
+        self.on_done = on_done
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.__condition = threading.Condition()
+        self.__stages: Dict[Hashable, Stage] = {}
+        self.__dependents: Dict[Hashable, List[Hashable]] = defaultdict(list)
+        self.__failed_groups: Set[Hashable] = set()
+        self.__unfinished_count = 0
+
+    def __enter__(self):
+        """Return scheduler, its executor is shut down on exit."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Wait till running stages finish and shut down executor."""
+        self.__executor.shutdown(wait=True)
+
+    def add_stage(
+        self,
+        key: Hashable,
+        func: Callable[[], Any],
+        depends_on: Iterable[Hashable] = (),
+        group: Optional[Hashable] = None,
+    ):
+        """Add stage into graph, it can be called also when other stages run.
+
+        :param key: Unique key of stage
+        :param func: Callable without arguments running the stage
+        :param depends_on: Keys of already added stages, which have to be done first
+        :param group: Group of stage, e.g. scene ID
+        """
+        with self.__condition:
+            if key in self.__stages:
+                raise ValueError(f"Stage {key} is already added.")
+            depends_on = set(depends_on)
+            stage = Stage(key, func, depends_on, group)
+            self.__stages[key] = stage
+            self.__unfinished_count += 1
+            for dependency_key in depends_on:
+                dependency = self.__stages[dependency_key]
+                if dependency.status == Stage.DONE:
+                    stage.waiting_for.discard(dependency_key)
+                elif dependency.status in (Stage.FAILED, Stage.SKIPPED):
+                    stage.status = Stage.SKIPPED
+                self.__dependents[dependency_key].append(key)
+            if stage.status == Stage.SKIPPED or group in self.__failed_groups:
+                self.__skip(stage)
+            elif not stage.waiting_for:
+                self.__submit(stage)
+
+    def result(self, key: Hashable) -> Any:
+        """Return result of done stage."""
+        with self.__condition:
+            stage = self.__stages[key]
+            if stage.status != Stage.DONE:
+                raise RuntimeError(f"Stage {key} is not done, status: {stage.status}.")
+            return stage.result
+
+    def pop_result(self, key: Hashable) -> Any:
+        """Return result of done stage and release it from scheduler memory."""
+        with self.__condition:
+            result = self.result(key)
+            self.__stages[key].result = None
+            return result
+
+    def status(self, key: Hashable) -> str:
+        """Return status of stage."""
+        with self.__condition:
+            return self.__stages[key].status
+
+    def join(self):
+        """Wait till all added stages are finished (done, failed or skipped)."""
+        with self.__condition:
+            while self.__unfinished_count > 0:
+                self.__condition.wait()
+
+    def __submit(self, stage: Stage):
+        """Submit stage into executor, lock has to be acquired."""
+        stage.status = Stage.RUNNING
+        self.__executor.submit(self.__run_stage, stage)
+
+    def __run_stage(self, stage: Stage):
+        """Run stage in worker thread."""
+        try:
+            result = stage.func()
+        except Exception as error:  # pylint: disable=W0703
+            self.__fail(stage, error)
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(lambda future: self.__finish_future(stage, future))
+        else:
+            self.__done(stage, result)
+
+    def __finish_future(self, stage: Stage, future: Future):
+        """Finish stage, which returned future."""
+        try:
+            result = future.result()
+        except Exception as error:  # pylint: disable=W0703
+            self.__fail(stage, error)
+            return
+        self.__done(stage, result)
+
+    def __done(self, stage: Stage, result: Any):
+        """Mark stage as done and submit stages waiting for it."""
+        if self.on_done is not None:
+            try:
+                self.on_done(stage.key, result)
+            except Exception as error:  # pylint: disable=W0703
+                self.__fail(stage, error)
+                return
+        with self.__condition:
+            stage.result = result
+            stage.status = Stage.DONE
+            for dependent_key in self.__dependents[stage.key]:
+                dependent = self.__stages[dependent_key]
+                dependent.waiting_for.discard(stage.key)
+                if dependent.status == Stage.PENDING and not dependent.waiting_for:
+                    self.__submit(dependent)
+            self.__finish(stage)
+
+    def __fail(self, stage: Stage, error: BaseException):
+        """Mark stage as failed and skip its group and dependent stages."""
+        logger.warning(f"Stage {stage.key} failed: {error!r}")
+        if self.on_failure is not None:
+            self.on_failure(stage.key, error)
+        with self.__condition:
+            stage.status = Stage.FAILED
+            if stage.group is not None:
+                self.__failed_groups.add(stage.group)
+                for other_stage in list(self.__stages.values()):
+                    if (
+                        other_stage.group == stage.group
+                        and other_stage.status == Stage.PENDING
+                    ):
+                        self.__skip(other_stage)
+            self.__skip_dependents(stage)
+            self.__finish(stage)
+
+    def __skip(self, stage: Stage):
+        """Skip stage and all stages depending on it, lock has to be acquired."""
+        stage.status = Stage.SKIPPED
+        self.__skip_dependents(stage)
+        self.__finish(stage)
+
+    def __skip_dependents(self, stage: Stage):
+        """Skip all pending stages depending on stage, lock has to be acquired."""
+        for dependent_key in self.__dependents[stage.key]:
+            dependent = self.__stages[dependent_key]
+            if dependent.status == Stage.PENDING:
+                self.__skip(dependent)
+
+    def __finish(self, stage: Stage):
+        """Count finished stage, lock has to be acquired."""
+        logger.debug(f"Stage {stage.key} finished with status {stage.status}.")
+        self.__unfinished_count -= 1
+        self.__condition.notify_all()
@@ -1,3 +1,75 @@
 """File to keep settings for sk_client project."""
+import os
 
 SPACEKNOW_CLIENT_ID = "hmWJcfhRouDOaJK2L8asREMlMrv3jFE1"
+
+# Number of tiles downloaded concurrently from Kraken grid
+TILE_DOWNLOAD_WORKERS = 8
+
+# Number of kept-alive HTTP connections in API client pool (per host)
+# in addition to connections of tile downloads of all stages,
+# e.g. for polling pipelines, releases and prefetching of search pages
+HTTP_POOL_HEADROOM = 16
+
+# Max. number of retries of failed query, delay before first retry
+# and max. delay between retries in seconds (jittered exponential backoff)
+HTTP_MAX_RETRIES = 5
+HTTP_RETRY_BASE_DELAY = 0.5
+HTTP_RETRY_MAX_DELAY = 30.0
+# Rate limit of queries of all threads (queries per second), it is decreased,
+# when server throttles queries, and increased by HTTP_RATE_INCREASE
+# after each successful query, max. queries sent at once
+HTTP_MAX_RATE = 200.0
+HTTP_MIN_RATE = 1.0
+HTTP_RATE_INCREASE = 0.5
+HTTP_RATE_BURST = 32
+
+# Number of scenes, whose cost is estimated concurrently
+COST_ESTIMATE_WORKERS = 8
+
+# Number of analysis stages (of all scenes) running at the same time
+STAGE_WORKERS = 8
+
+# Persistent store of downloaded Kraken grid tiles and its size budget in bytes
+TILE_STORE_PATH = "cache/tiles.sqlite3"
+TILE_STORE_MAX_SIZE = 2 * 1024**3
+
+# Persistent store of Kraken releases and time to live of stored releases in seconds
+RELEASE_STORE_PATH = "cache/releases.sqlite3"
+RELEASE_STORE_TTL = 7 * 24 * 3600
+
+# Number of imagery tiles decoded concurrently during stitching
+STITCH_WORKERS = 8
+
+# Number of processes stitching and rendering imagery of scenes,
+# 0 to process imagery in stage threads of main process
+IMAGE_PROCESS_WORKERS = os.cpu_count() or 1
+
+# Stitched imagery bigger than this limit (in bytes) is memory-mapped from disk
+MOSAIC_IN_MEMORY_LIMIT = 2 * 1024**3
+# Number of pixel rows of memory-mapped imagery processed at once
+MOSAIC_STRIP_HEIGHT = 2048
+# Number of strips of memory-mapped imagery compressed concurrently into PNG
+PNG_ENCODE_WORKERS = 8
+
+# Number of output images encoded at the same time in background threads
+IMAGE_ENCODE_WORKERS = 2
+# Format of output images: "png", "webp" (lossless), "jpeg" or "raw" (.npy),
+# and its quality (compression level 0-9 for png, 0-100 for jpeg), None - default
+OUTPUT_FORMAT = "png"
+OUTPUT_QUALITY = None
+# Format and quality of interactive previews, speed wins over file size
+PREVIEW_FORMAT = "jpeg"
+PREVIEW_QUALITY = 80
+# Max. width and height of scene preview in pixels
+PREVIEW_MAX_SIZE = 1024
+
+# Checkpoint of running analyses, saved after each done stage, see 'resume' command
+CHECKPOINT_PATH = "cache/checkpoint.pickle"
+
+# Persistent store of detected objects of all analysed scenes
+DETECTION_STORE_PATH = "cache/detections.sqlite3"
+
+# Max. gap between fragments of one detected object split by tile border,
+# as fraction of detection tile size
+DETECTION_MERGE_TOLERANCE = 1 / 256
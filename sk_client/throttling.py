@@ -0,0 +1,195 @@
+"""Module with retrying and rate limiting of queries to SpaceKnow API."""
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+from typing import Optional
+import logging
+import random
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class RetryPolicy:
+    """Policy of retrying failed queries with jittered exponential backoff.
+
+    Queries throttled (429) or rejected by unavailable server (503) were not
+    processed, so they are retried always. Other temporary server errors
+    and connection errors are retried only for idempotent queries (GET queries
+    and read-only POST queries, e.g. status of pipeline), so e.g. POST query
+    releasing pipeline is not sent twice.
+    """
+
+    # statuses of queries, which were not processed by server
+    RETRY_STATUSES = frozenset(
+        (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE)
+    )
+    # statuses of temporary errors of queries, which could be processed
+    IDEMPOTENT_RETRY_STATUSES = frozenset(
+        (
+            HTTPStatus.INTERNAL_SERVER_ERROR,
+            HTTPStatus.BAD_GATEWAY,
+            HTTPStatus.GATEWAY_TIMEOUT,
+        )
+    )
+
+    def __init__(self, max_retries: int, base_delay: float, max_delay: float):
+        """Create policy.
+
+        :param max_retries: Max. number of retries of one query
+        :param base_delay: Delay before first retry in seconds,
+            it is doubled with each retry
+        :param max_delay: Max. delay between retries in seconds,
+            delay given by Retry-After header is not limited
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_transient(self, status_code: Optional[int]) -> bool:
+        """Return if HTTP status is temporary error, e.g. after retries ran out."""
+        return (
+            status_code in self.RETRY_STATUSES
+            or status_code in self.IDEMPOTENT_RETRY_STATUSES
+        )
+
+    def is_transient_error(self, error: Exception) -> bool:
+        """Return if failed query can succeed later, e.g. after retries ran out."""
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            return self.is_transient(error.response.status_code)
+        return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+    def is_retryable_status(self, status_code: int, idempotent: bool) -> bool:
+        """Return if query with response of given status is retried.
+
+        :param idempotent: If query can be sent more times with the same effect
+        """
+        if status_code in self.RETRY_STATUSES:
+            return True
+        return idempotent and status_code in self.IDEMPOTENT_RETRY_STATUSES
+
+    @staticmethod
+    def is_retryable_error(error: requests.RequestException, idempotent: bool) -> bool:
+        """Return if query failed with connection error is retried.
+
+        :param idempotent: If query can be sent more times with the same effect
+        """
+        if isinstance(error, requests.ConnectTimeout):
+            # query was not sent at all
+            return True
+        return idempotent and isinstance(
+            error, (requests.ConnectionError, requests.Timeout)
+        )
+
+    def get_delay(
+        self, attempt: int, response: Optional[requests.Response] = None
+    ) -> float:
+        """Return delay in seconds before next attempt of query.
+
+        Delay from Retry-After header of response is used, if it is given,
+        otherwise delay is random from zero to exponential backoff (full jitter),
+        so retries of concurrent queries are spread in time.
+
+        :param attempt: Number of failed attempts of query, from 1
+        """
+        retry_after = get_retry_after(response) if response is not None else None
+        if retry_after is not None:
+            return retry_after
+        backoff = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, backoff)
+
+
+def get_retry_after(response: requests.Response) -> Optional[float]:
+    """Return delay in seconds from Retry-After header, None if it is not valid.
+
+    Header can be given in seconds or as HTTP date.
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:  # pylint: disable=R0902
+    """Token bucket limiting rate of queries, shared by all threads of client.
+
+    Rate is decreased multiplicatively, when server throttles queries (429),
+    and increased additively with each successful query, up to max. rate.
+    When server sends Retry-After, all queries are paused for given time.
+    """
+
+    # factor, by which rate is multiplied, when queries are throttled
+    DECREASE_FACTOR = 0.5
+    # min. time in seconds between two decreases of rate, so more queries
+    # throttled at once decrease rate only once
+    DECREASE_INTERVAL = 1.0
+
+    def __init__(self, max_rate: float, min_rate: float, increase: float, burst: int):
+        """Create rate limiter, starting with max. rate.
+
+        :param max_rate: Max. number of queries per second
+        :param min_rate: Min. number of queries per second
+        :param increase: Increase of rate (queries per second)
+            after each successful query
+        :param burst: Max. number of queries sent at once (bucket capacity)
+        """
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.burst = burst
+        self.rate = max_rate
+        self.__tokens = float(burst)
+        self.__updated = time.monotonic()
+        self.__paused_until = 0.0
+        self.__last_decrease = float("-inf")
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """Wait till query can be sent."""
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__refill(now)
+                if now >= self.__paused_until and self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                delay = max(self.__paused_until - now, (1 - self.__tokens) / self.rate)
+            time.sleep(delay)
+
+    def on_success(self):
+        """Increase rate after successful query."""
+        with self.__lock:
+            self.__refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttled(self, retry_after: Optional[float] = None):
+        """Decrease rate after throttled query.
+
+        :param retry_after: Delay from Retry-After header, all queries
+            are paused for this time
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__refill(now)
+            if now - self.__last_decrease >= self.DECREASE_INTERVAL:
+                self.__last_decrease = now
+                self.rate = max(self.min_rate, self.rate * self.DECREASE_FACTOR)
+                logger.info(f"Queries throttled, rate decreased to {self.rate}/s.")
+            if retry_after is not None:
+                self.__paused_until = max(self.__paused_until, now + retry_after)
+
+    def __refill(self, now: float):
+        """Add tokens for time since last refill, lock has to be acquired."""
+        self.__tokens = min(
+            self.burst, self.__tokens + (now - self.__updated) * self.rate
+        )
+        self.__updated = now
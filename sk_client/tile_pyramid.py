@@ -0,0 +1,249 @@
+"""Module with multi-resolution tile pyramid output of rendered imagery."""
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+import logging
+import shutil
+import sqlite3
+
+import cv2
+import numpy as np
+
+from . import utils
+from .image_encoder import ImageEncoder
+from .tiles import TileSet
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+
+
+class MBTilesContainer:
+    """Tile pyramid in one SQLite file in MBTiles format.
+
+    See: https://github.com/mapbox/mbtiles-spec
+    Rows of tiles are stored in TMS scheme (y axis from south to north).
+    """
+
+    def __init__(self, path: str):
+        """Create container, existing file is replaced."""
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).unlink(missing_ok=True)
+        self.__connection = sqlite3.connect(path)
+        self.__connection.executescript(
+            "CREATE TABLE metadata (name TEXT, value TEXT);"
+            "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, "
+            "tile_row INTEGER, tile_data BLOB);"
+            "CREATE UNIQUE INDEX tile_index ON tiles "
+            "(zoom_level, tile_column, tile_row);"
+        )
+
+    def put(self, z: int, x: int, y: int, data: bytes):
+        """Store encoded tile given in XYZ scheme."""
+        self.__connection.execute(
+            "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+            (z, x, 2**z - 1 - y, data),
+        )
+
+    def close(self, metadata: Dict[str, str]):
+        """Store metadata of pyramid and close container."""
+        self.__connection.executemany(
+            "INSERT INTO metadata VALUES (?, ?)", metadata.items()
+        )
+        self.__connection.commit()
+        self.__connection.close()
+
+
+class DirectoryContainer:
+    """Tile pyramid in directory tree {z}/{x}/{y}.{extension} (XYZ scheme).
+
+    Metadata of pyramid are saved in metadata.json.
+    """
+
+    def __init__(self, path: str, tile_extension: str):
+        """Create container, existing directory is replaced.
+
+        :param path: Path of directory
+        :param tile_extension: Extension of tile files, e.g. "png"
+        """
+        self.path = path
+        self.tile_extension = tile_extension
+        shutil.rmtree(path, ignore_errors=True)
+        Path(path).mkdir(parents=True)
+
+    def put(self, z: int, x: int, y: int, data: bytes):
+        """Store encoded tile."""
+        tile_path = Path(self.path, str(z), str(x), f"{y}.{self.tile_extension}")
+        tile_path.parent.mkdir(parents=True, exist_ok=True)
+        tile_path.write_bytes(data)
+
+    def close(self, metadata: Dict[str, str]):
+        """Store metadata of pyramid."""
+        with open(Path(self.path, "metadata.json"), "w", encoding="utf-8") as file:
+            file.write(utils.pretty_format_json(metadata))
+
+
+# "mbtiles" - one SQLite file, "xyz" - directory tree
+PYRAMID_FORMATS = ("mbtiles", "xyz")
+
+
+class TilePyramidBuilder:
+    """Build tile pyramid from tiles of the highest zoom level.
+
+    Overviews are built incrementally: each added tile is downsampled
+    into quadrant of its parent tile, parent tile is added (and encoded),
+    as soon as all its children are added. When tiles are added row by row,
+    only parents of two rows of tiles of each level are kept in memory.
+
+    Fully transparent tiles are not stored.
+    """
+
+    def __init__(
+        self,
+        tiles: TileSet,
+        container: Union[MBTilesContainer, DirectoryContainer],
+        encoder: ImageEncoder,
+        min_zoom: Optional[int] = None,
+    ):
+        """Create builder.
+
+        :param tiles: All tiles of the highest zoom level, which will be added
+        :param container: Container, where encoded tiles are stored
+        :param encoder: Encoder of tiles
+        :param min_zoom: Zoom of the smallest overview, None for zoom,
+            where all tiles are covered by one tile
+        """
+        self.container = container
+        self.encoder = encoder
+        self.max_zoom = tiles.zoom
+        # zoom -> (x, y) of tile -> number of its not added children
+        self.__waiting_children: Dict[int, Dict[Tuple[int, int], int]] = {}
+        self.__overviews: Dict[int, Dict[Tuple[int, int], np.ndarray]] = {}
+        level_tiles = tiles
+        while self.__has_overview(level_tiles, min_zoom):
+            level_tiles, children_counts = level_tiles.count_children()
+            self.__waiting_children[level_tiles.zoom] = {
+                (x, y): count
+                for (_, x, y), count in zip(level_tiles, children_counts.tolist())
+            }
+            self.__overviews[level_tiles.zoom] = {}
+        self.min_zoom = level_tiles.zoom
+        self.stored_count = 0
+
+    @staticmethod
+    def __has_overview(level_tiles: TileSet, min_zoom: Optional[int]) -> bool:
+        """Return if overview of tiles (one zoom level lower) is built."""
+        if min_zoom is None:
+            return level_tiles.zoom > 0 and len(level_tiles) > 1
+        return level_tiles.zoom > min_zoom
+
+    def add_tile(self, z: int, x: int, y: int, image: np.ndarray):
+        """Add tile in BGRA colors and all its completed parents."""
+        if not np.any(image[:, :, 3]):
+            image = None
+        if image is not None:
+            self.container.put(z, x, y, self.encoder.encode(image))
+            self.stored_count += 1
+        if z == self.min_zoom:
+            return
+        parent = (x // 2, y // 2)
+        overviews = self.__overviews[z - 1]
+        if image is not None:
+            overview = overviews.get(parent)
+            if overview is None:
+                overview = overviews[parent] = np.zeros(
+                    (TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8
+                )
+            half = TILE_SIZE // 2
+            top = (y % 2) * half
+            bottom = top + half
+            left = (x % 2) * half
+            right = left + half
+            overview[top:bottom, left:right] = cv2.resize(
+                image, (half, half), interpolation=cv2.INTER_AREA
+            )
+        waiting_children = self.__waiting_children[z - 1]
+        waiting_children[parent] -= 1
+        if waiting_children[parent] == 0:
+            del waiting_children[parent]
+            overview = overviews.pop(parent, None)
+            if overview is None:
+                overview = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+            self.add_tile(z - 1, *parent, overview)
+
+    def add_row(self, row: TileSet, strip: np.ndarray, min_x: int):
+        """Add row of tiles cut from strip of imagery.
+
+        :param row: Tiles in one row
+        :param strip: Strip of imagery with height of one tile
+        :param min_x: X coordinate of tile at left border of strip
+        """
+        for z, x, y in row:
+            left = (x - min_x) * TILE_SIZE
+            right = left + TILE_SIZE
+            self.add_tile(z, x, y, strip[:, left:right])
+
+    def get_metadata(self, name: str, tiles: TileSet) -> Dict[str, str]:
+        """Return metadata of pyramid in MBTiles format."""
+        west, south, east, north = tiles.bounds()
+        return {
+            "name": name,
+            "type": "overlay",
+            "version": "1.0",
+            "format": self.encoder.extension,
+            "minzoom": str(self.min_zoom),
+            "maxzoom": str(self.max_zoom),
+            "bounds": f"{west.min()},{south.min()},{east.max()},{north.max()}",
+        }
+
+
+def write_tile_pyramid(
+    imagery: np.ndarray,
+    imagery_tiles: TileSet,
+    path_without_extension: str,
+    pyramid_format: str = "mbtiles",
+    encoder: Optional[ImageEncoder] = None,
+) -> str:
+    """Write stitched (rendered) imagery as tile pyramid with overviews.
+
+    Imagery is cut into tiles of imagery_tiles grid (tiles downloaded
+    by download_imagery_analysis_tiles), one row of tiles at time,
+    so memory-mapped imagery is never loaded in memory at once.
+    Overviews are built from these tiles, see TilePyramidBuilder.
+
+    :param imagery: Stitched imagery of imagery_tiles in BGRA colors
+    :param imagery_tiles: Tiles of stitched imagery
+    :param path_without_extension: Path of pyramid without extension,
+        extension is given by pyramid format
+    :param pyramid_format: One of PYRAMID_FORMATS
+    :param encoder: Encoder of tiles, default is PNG encoder
+    :return: Path of pyramid, e.g. "result/scene/result.mbtiles"
+    :raise ValueError: Unsupported pyramid format
+    """
+    encoder = encoder or ImageEncoder()
+    container = __create_container(path_without_extension, pyramid_format, encoder)
+    builder = TilePyramidBuilder(imagery_tiles, container, encoder)
+    min_x, min_y, _, _ = imagery_tiles.bounding_box()
+    for y, row in imagery_tiles.rows():
+        top = (y - min_y) * TILE_SIZE
+        bottom = top + TILE_SIZE
+        builder.add_row(row, np.ascontiguousarray(imagery[top:bottom]), min_x)
+    container.close(
+        builder.get_metadata(Path(path_without_extension).parent.name, imagery_tiles)
+    )
+    logger.info(
+        f"Tile pyramid with {builder.stored_count} tiles written into "
+        f"{container.path}."
+    )
+    return container.path
+
+
+def __create_container(
+    path_without_extension: str, pyramid_format: str, encoder: ImageEncoder
+) -> Union[MBTilesContainer, DirectoryContainer]:
+    """Create container of tile pyramid in given format."""
+    if pyramid_format == "mbtiles":
+        return MBTilesContainer(f"{path_without_extension}.mbtiles")
+    if pyramid_format == "xyz":
+        return DirectoryContainer(f"{path_without_extension}-tiles", encoder.extension)
+    raise ValueError(f"Unsupported tile pyramid format: {pyramid_format}")
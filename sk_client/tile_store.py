@@ -0,0 +1,190 @@
+"""Module with persistent store of downloaded Kraken grid tiles."""
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# key of tile: (mapId, z, x, y, file name)
+TileKey = Tuple[str, int, int, int, str]
+
+
+class TileStore:
+    """Persistent store of downloaded Kraken grid tiles.
+
+    Tiles are packed into one SQLite database file instead of many small files,
+    each tile is keyed by (mapId, z, x, y, file name).
+    Empty tiles (HTTP 204) are stored as negative entries without data.
+
+    When total size of stored tiles exceeds size budget, least recently used
+    tiles are evicted. Store can be used from more threads.
+
+    Access times of read tiles are kept in memory and written in batches,
+    so reading of stored tiles does not commit transaction for each tile.
+    """
+
+    # after exceeding budget, evict tiles till this fraction of budget is used
+    EVICTION_TARGET = 0.9
+    # number of tiles read since last write of access times,
+    # after which access times are written
+    ACCESS_FLUSH_SIZE = 256
+
+    def __init__(self, path: str, max_size: int):
+        """Open (or create) tile store.
+
+        :param path: Path to database file
+        :param max_size: Size budget of stored tile data in bytes
+        """
+        self.path = path
+        self.max_size = max_size
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__access_times: Dict[TileKey, float] = {}
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS tiles ("
+            "map_id TEXT, z INTEGER, x INTEGER, y INTEGER, file_name TEXT, "
+            "data BLOB, size INTEGER NOT NULL, last_access REAL NOT NULL, "
+            "PRIMARY KEY (map_id, z, x, y, file_name))"
+        )
+        self.__connection.execute(
+            "CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (last_access)"
+        )
+        self.__connection.commit()
+        self.__size = self.__connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM tiles"
+        ).fetchone()[0]
+
+    @property
+    def size(self) -> int:
+        """Return total size of stored tile data in bytes."""
+        return self.__size
+
+    def get(self, key: TileKey) -> Optional[bytes]:
+        """Return stored tile data.
+
+        :return: Tile data or None for empty tile
+        :raise KeyError: Tile is not stored
+        """
+        with self.__lock:
+            row = self.__connection.execute(
+                "SELECT data FROM tiles "
+                "WHERE map_id=? AND z=? AND x=? AND y=? AND file_name=?",
+                key,
+            ).fetchone()
+            if row is None:
+                raise KeyError(key)
+            self.__access_times[key] = time.time()
+            if len(self.__access_times) >= self.ACCESS_FLUSH_SIZE:
+                self.__flush_access_times()
+                self.__connection.commit()
+        return row[0]
+
+    def put(self, key: TileKey, data: Optional[bytes]):
+        """Store tile data, None is stored as negative entry for empty tile."""
+        size = len(data) if data is not None else 0
+        with self.__lock:
+            self.__access_times.pop(key, None)
+            row = self.__connection.execute(
+                "SELECT size FROM tiles "
+                "WHERE map_id=? AND z=? AND x=? AND y=? AND file_name=?",
+                key,
+            ).fetchone()
+            if row is not None:
+                self.__size -= row[0]
+            self.__connection.execute(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, data, size, time.time()),
+            )
+            self.__size += size
+            if self.__size > self.max_size:
+                self.__flush_access_times()
+                self.__evict()
+            self.__connection.commit()
+
+    def __flush_access_times(self):
+        """Write access times of read tiles, lock has to be acquired."""
+        self.__connection.executemany(
+            "UPDATE tiles SET last_access=? "
+            "WHERE map_id=? AND z=? AND x=? AND y=? AND file_name=?",
+            [(access_time, *key) for key, access_time in self.__access_times.items()],
+        )
+        self.__access_times.clear()
+
+    def __evict(self):
+        """Evict least recently used tiles, lock has to be acquired."""
+        target_size = self.max_size * self.EVICTION_TARGET
+        cursor = self.__connection.execute(
+            "SELECT rowid, size FROM tiles ORDER BY last_access"
+        )
+        evicted_rowids = []
+        for rowid, size in cursor:
+            if self.__size <= target_size:
+                break
+            evicted_rowids.append((rowid,))
+            self.__size -= size
+        self.__connection.executemany("DELETE FROM tiles WHERE rowid=?", evicted_rowids)
+        logger.info(f"Evicted {len(evicted_rowids)} tiles from tile store.")
+
+    def flush(self):
+        """Write access times of read tiles, which were not written yet."""
+        with self.__lock:
+            self.__flush_access_times()
+            self.__connection.commit()
+
+    def close(self):
+        """Write access times of read tiles and close database connection."""
+        self.flush()
+        with self.__lock:
+            self.__connection.close()
+
+
+class StoredTileReader:
+    """Reader of tiles of one map from tile store, which can be pickled.
+
+    Reader opens own read-only connection to tile store in process,
+    where it is used, so tiles can be read e.g. in process pool.
+    Access times of read tiles are not changed.
+    """
+
+    def __init__(self, path: str, map_id: str, file_name: str):
+        """Create reader.
+
+        :param path: Path to database file of tile store
+        :param map_id: ID of map of read tiles
+        :param file_name: Name of file of read tiles, e.g. "truecolor.png"
+        """
+        self.path = path
+        self.map_id = map_id
+        self.file_name = file_name
+        self.__lock = threading.Lock()
+        self.__connection: Optional[sqlite3.Connection] = None
+
+    def __getstate__(self):
+        """Return state for pickling, without connection and lock."""
+        return {"path": self.path, "map_id": self.map_id, "file_name": self.file_name}
+
+    def __setstate__(self, state):
+        """Restore reader from pickled state, connection is opened on first read."""
+        self.__dict__.update(state)
+        self.__lock = threading.Lock()
+        self.__connection = None
+
+    def __call__(self, z: int, x: int, y: int) -> Optional[bytes]:
+        """Return tile data, None for empty tile or tile, which is not stored."""
+        with self.__lock:
+            if self.__connection is None:
+                self.__connection = sqlite3.connect(
+                    f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+                )
+            row = self.__connection.execute(
+                "SELECT data FROM tiles "
+                "WHERE map_id=? AND z=? AND x=? AND y=? AND file_name=?",
+                (self.map_id, z, x, y, self.file_name),
+            ).fetchone()
+        return row[0] if row is not None else None
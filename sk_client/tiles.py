@@ -0,0 +1,238 @@
+"""Module with compact set of map tiles."""
+from typing import Iterable, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+
+class TileSet:
+    """Set of map tiles of one zoom level, stored in NumPy array.
+
+    Each tile is stored as one int64 key (y << 32 | x), keys are unique
+    and sorted, so tiles are ordered row by row (by y, then by x).
+    Million tiles take 8 MB and all operations are vectorized.
+
+    Iteration is lazy and yields tiles in format (z, x, y) with Python ints.
+
+    Usage:
+        tiles = TileSet.from_list([[14, 8800, 5400], [14, 8801, 5400]])
+        for z, x, y in tiles.zoom_to(16):
+            ...
+    """
+
+    # number of tiles converted to Python ints at once during iteration
+    ITERATION_CHUNK_SIZE = 4096
+
+    __COORDINATE_BITS = 32
+    __COORDINATE_MASK = (1 << __COORDINATE_BITS) - 1
+
+    def __init__(self, zoom: int, keys: np.ndarray):
+        """Create tile set, use class methods (e.g. from_list) instead.
+
+        :param zoom: Zoom level of all tiles
+        :param keys: Sorted unique keys of tiles (int64)
+        """
+        self.zoom = int(zoom)
+        self.keys = keys
+
+    @classmethod
+    def empty(cls, zoom: int) -> "TileSet":
+        """Create empty tile set."""
+        return cls(zoom, np.empty(0, dtype=np.int64))
+
+    @classmethod
+    def from_xy(cls, zoom: int, x: Iterable[int], y: Iterable[int]) -> "TileSet":
+        """Create tile set from x and y coordinates of tiles, duplicates are removed.
+
+        :param zoom: Zoom level of all tiles
+        :param x: X coordinates of tiles
+        :param y: Y coordinates of tiles
+        """
+        x = np.asarray(x, dtype=np.int64)
+        y = np.asarray(y, dtype=np.int64)
+        return cls(zoom, np.unique((y << cls.__COORDINATE_BITS) | x))
+
+    @classmethod
+    def from_list(cls, tiles: Sequence[Sequence[int]]) -> "TileSet":
+        """Create tile set from tiles in format [[z, x, y], ...].
+
+        :raise ValueError: Tiles are not in the same zoom level
+        """
+        if len(tiles) == 0:
+            raise ValueError("Zoom level of empty list of tiles is unknown.")
+        array = np.asarray(tiles, dtype=np.int64).reshape(-1, 3)
+        zoom = array[0, 0]
+        if np.any(array[:, 0] != zoom):
+            raise ValueError("All tiles have to be in the same zoom level.")
+        return cls.from_xy(zoom, array[:, 1], array[:, 2])
+
+    @classmethod
+    def union_all(cls, zoom: int, tile_sets: Iterable["TileSet"]) -> "TileSet":
+        """Create tile set with tiles of all sets, zoomed to zoom.
+
+        Faster than repeated union, keys of all sets are sorted only once.
+
+        :param zoom: Zoom level of created set
+        :param tile_sets: Tile sets of any zoom levels
+        """
+        keys = np.sort(
+            np.concatenate(
+                [np.empty(0, dtype=np.int64)]
+                + [tile_set.zoom_to(zoom).keys for tile_set in tile_sets]
+            )
+        )
+        is_unique = np.empty(len(keys), dtype=bool)
+        is_unique[:1] = True
+        np.not_equal(keys[1:], keys[:-1], out=is_unique[1:])
+        return cls(zoom, keys[is_unique])
+
+    @property
+    def x(self) -> np.ndarray:
+        """Return x coordinates of tiles."""
+        return self.keys & self.__COORDINATE_MASK
+
+    @property
+    def y(self) -> np.ndarray:
+        """Return y coordinates of tiles."""
+        return self.keys >> self.__COORDINATE_BITS
+
+    def __len__(self):
+        """Return number of tiles."""
+        return len(self.keys)
+
+    def __iter__(self) -> Iterator[Tuple[int, int, int]]:
+        """Iterate over tiles in format (z, x, y)."""
+        for start in range(0, len(self.keys), self.ITERATION_CHUNK_SIZE):
+            end = start + self.ITERATION_CHUNK_SIZE
+            chunk = self.keys[start:end]
+            x_values = (chunk & self.__COORDINATE_MASK).tolist()
+            y_values = (chunk >> self.__COORDINATE_BITS).tolist()
+            for x, y in zip(x_values, y_values):
+                yield self.zoom, x, y
+
+    def __contains__(self, tile) -> bool:
+        """Return if tile in format (z, x, y) is in set."""
+        z, x, y = tile
+        if z != self.zoom:
+            return False
+        key = (y << self.__COORDINATE_BITS) | x
+        index = np.searchsorted(self.keys, key)
+        return bool(index < len(self.keys) and self.keys[index] == key)
+
+    def __eq__(self, other) -> bool:
+        """Return if both sets have the same zoom and tiles."""
+        if not isinstance(other, TileSet):
+            return NotImplemented
+        return self.zoom == other.zoom and np.array_equal(self.keys, other.keys)
+
+    def __repr__(self):
+        """Return zoom and number of tiles."""
+        return f"TileSet(zoom={self.zoom}, tiles={len(self)})"
+
+    def __or__(self, other: "TileSet") -> "TileSet":
+        """Return union, see union."""
+        return self.union(other)
+
+    def __and__(self, other: "TileSet") -> "TileSet":
+        """Return intersection, see intersection."""
+        return self.intersection(other)
+
+    def __sub__(self, other: "TileSet") -> "TileSet":
+        """Return difference, see difference."""
+        return self.difference(other)
+
+    def union(self, other: "TileSet") -> "TileSet":
+        """Return tiles in any of sets, other set is zoomed to zoom of this set."""
+        other = other.zoom_to(self.zoom)
+        return TileSet(self.zoom, np.union1d(self.keys, other.keys))
+
+    def intersection(self, other: "TileSet") -> "TileSet":
+        """Return tiles in both sets, other set is zoomed to zoom of this set."""
+        other = other.zoom_to(self.zoom)
+        return TileSet(
+            self.zoom, np.intersect1d(self.keys, other.keys, assume_unique=True)
+        )
+
+    def difference(self, other: "TileSet") -> "TileSet":
+        """Return tiles not in other set, other set is zoomed to zoom of this set."""
+        other = other.zoom_to(self.zoom)
+        return TileSet(
+            self.zoom, np.setdiff1d(self.keys, other.keys, assume_unique=True)
+        )
+
+    def filter(self, mask: Sequence[bool]) -> "TileSet":
+        """Return tiles, for which mask is True.
+
+        :param mask: One boolean value for each tile, in order of iteration
+        """
+        return TileSet(self.zoom, self.keys[np.asarray(mask, dtype=bool)])
+
+    def zoom_to(self, zoom: int) -> "TileSet":
+        """Return tiles covering the same area in another zoom level.
+
+        Zooming in replaces each tile by its 4^k children,
+        zooming out replaces tiles by their (unique) parents.
+        """
+        zoom_step = zoom - self.zoom
+        if zoom_step == 0:
+            return self
+        if zoom_step < 0:
+            return TileSet.from_xy(zoom, self.x >> -zoom_step, self.y >> -zoom_step)
+        offsets = np.arange(2**zoom_step, dtype=np.int64)
+        x = (self.x[:, np.newaxis] << zoom_step) + offsets
+        y = (self.y[:, np.newaxis] << zoom_step) + offsets
+        keys = (y[:, :, np.newaxis] << self.__COORDINATE_BITS) | x[:, np.newaxis, :]
+        # children of different tiles are not overlapping, no duplicates
+        return TileSet(zoom, np.sort(keys.ravel()))
+
+    def count_children(self) -> Tuple["TileSet", np.ndarray]:
+        """Return parent tiles (one zoom level lower) and their children counts.
+
+        :return: Parent tiles and number of children of each parent
+            in this set, in order of iteration of parents
+        """
+        parent_keys = ((self.y >> 1) << self.__COORDINATE_BITS) | (self.x >> 1)
+        keys, counts = np.unique(parent_keys, return_counts=True)
+        return TileSet(self.zoom - 1, keys), counts
+
+    def bounding_box(self) -> Tuple[int, int, int, int]:
+        """Return bounding box of tiles.
+
+        :return: Bounding box in format (min x, min y, max x, max y)
+        :raise ValueError: Tile set is empty
+        """
+        if len(self) == 0:
+            raise ValueError("Bounding box of empty tile set is not defined.")
+        x = self.x
+        # keys are sorted by y first
+        min_y = int(self.keys[0] >> self.__COORDINATE_BITS)
+        max_y = int(self.keys[-1] >> self.__COORDINATE_BITS)
+        return int(x.min()), min_y, int(x.max()), max_y
+
+    def bounds(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Return geographic bounds of all tiles, see utils.get_tile_bounds.
+
+        :return: Arrays (west, south, east, north) in degrees
+        """
+        tiles_count = 2.0**self.zoom
+        x = self.x
+        y = self.y
+        west = x / tiles_count * 360 - 180
+        east = (x + 1) / tiles_count * 360 - 180
+        north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / tiles_count))))
+        south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / tiles_count))))
+        return west, south, east, north
+
+    def rows(self) -> Iterator[Tuple[int, "TileSet"]]:
+        """Iterate over rows of tiles from top to bottom.
+
+        :return: Iterator of (y, tiles in row)
+        """
+        y = self.y
+        row_starts = np.flatnonzero(np.diff(y)) + 1
+        for keys in np.split(self.keys, row_starts):
+            if len(keys) > 0:
+                yield int(keys[0] >> self.__COORDINATE_BITS), TileSet(self.zoom, keys)
+
+    def to_list(self) -> List[List[int]]:
+        """Return tiles in format [[z, x, y], ...]."""
+        return [list(tile) for tile in self]
@@ -7,6 +7,8 @@ from typing import List, Literal, TypedDict
 
 from typing_extensions import NotRequired
 
+from .tiles import TileSet
+
 
 class Credentials(TypedDict):
     """Credentials for SpaceKnow API."""
@@ -101,4 +103,4 @@ class KrakenAnalysisResultData(TypedDict):
 
     mapId: str
     maxZoom: int
-    tiles: List[List[int]]  # List of map tiles, tile in format [z, x, y] coordinates
+    tiles: TileSet  # Map tiles, parsed from list of tiles in format [z, x, y]
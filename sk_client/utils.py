@@ -1,9 +1,15 @@
 """Utils for sk_client project."""
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, List, Optional, Tuple
 import os
 import json
 import math
-from typing import List
+import tempfile
 
+import numpy as np
+
+from .tiles import TileSet
 from .types import Credentials, ExtentData, FeatureCollectionData
 from .exceptions import ImproperlyConfiguredError
 
@@ -60,6 +66,40 @@ def pretty_print_json(json_dict: dict) -> None:
     print(pretty_format_json(json_dict))
 
 
+@contextmanager
+def open_atomically(path: str, mode: str = "wb", **kwargs) -> Iterator[IO]:
+    """Open temporary file, which replaces file in path, when it is closed.
+
+    Readers never see partially written file, file in path is not changed,
+    when writing is interrupted (or exception is raised).
+
+    :param mode: Mode of opened file, "wb" or "w"
+    :param kwargs: Other arguments of open, e.g. encoding
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    file_descriptor, temporary_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}."
+    )
+    try:
+        with open(file_descriptor, mode, **kwargs) as file:
+            yield file
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def get_detection_tile_path(
+    scene_id: str, z: int, x: int, y: int, extension: str = "bin"
+) -> str:
+    """Return path of detection tile file in "result" folder.
+
+    :param extension: "bin" for binary file (see TileDetections.save)
+        or "geojson" for GeoJSON file
+    """
+    return f"result/{scene_id}/detections-{z}-{x}-{y}.{extension}"
+
+
 def load_detection_tile_data(
     z: int, x: int, y: int, scene_id: str
 ) -> FeatureCollectionData:
@@ -67,9 +107,8 @@ def load_detection_tile_data(
 
     Data are loaded from "result" folder.
     """
-    with open(
-        f"result/{scene_id}/detections-{z}-{x}-{y}.geojson", "r", encoding="utf-8"
-    ) as file:
+    path = get_detection_tile_path(scene_id, z, x, y, "geojson")
+    with open(path, "r", encoding="utf-8") as file:
         return json.load(file)
 
 
@@ -81,12 +120,8 @@ def save_detection_tile_data(
     Data are saved into "result" folder.
     Each analysis data are in folder named by scene_id.
     """
-    data_dir = f"result/{scene_id}"
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
-    with open(
-        f"result/{scene_id}/detections-{z}-{x}-{y}.geojson", "w", encoding="utf-8"
-    ) as file:
+    path = get_detection_tile_path(scene_id, z, x, y, "geojson")
+    with open_atomically(path, "w", encoding="utf-8") as file:
         json.dump(detection_tile_data, file)
 
 
@@ -96,13 +131,27 @@ def save_imagery_tile_data(scene_id: str, imagery_tile_data, z: int, x: int, y:
     Data are saved into "result" folder.
     Each analysis data are in folder named by scene_id.
     """
-    data_dir = f"result/{scene_id}"
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
-    with open(f"result/{scene_id}/imagery-{z}-{x}-{y}.png", "wb") as file:
+    with open_atomically(get_imagery_tile_path(scene_id, z, x, y)) as file:
         file.write(imagery_tile_data)
 
 
+def load_imagery_tile_data(scene_id: str, z: int, x: int, y: int) -> Optional[bytes]:
+    """Load imagery tile data (PNG) from file, None when it is not saved.
+
+    Data are loaded from "result" folder.
+    """
+    path = get_imagery_tile_path(scene_id, z, x, y)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def get_imagery_tile_path(scene_id: str, z: int, x: int, y: int) -> str:
+    """Return path of imagery tile file in "result" folder."""
+    return f"result/{scene_id}/imagery-{z}-{x}-{y}.png"
+
+
 def convert_coordinates(longitude, latitude, zoom_level):
     """Convert geographic coordinates.
 
@@ -128,28 +177,200 @@ def convert_coordinates(longitude, latitude, zoom_level):
     return x, y
 
 
-def zoom_tiles(tiles: List[List[int]], zoom_to: int) -> List[List[int]]:
-    """Take list of tiles and "zoom" them.
+def convert_coordinates_array(coordinates: np.ndarray, zoom_level) -> np.ndarray:
+    """Convert array of geographic coordinates at once.
 
-    For this time this method support only zoom in and NOT zoom out.
+    Same conversion as convert_coordinates, but for all points at once.
 
-    This method return same number of tiles (if no zoom)
-    or bigger number of tiles when zoomed.
+    :param coordinates: Array of points in format [[longitude, latitude], ...]
+    :param zoom_level: Zoom level in map
+    :return: Array of points in format [[x, y], ...] (int64)
+    """
+    scale = (256 / (2 * math.pi)) * (2**zoom_level)
+    long = np.radians(coordinates[:, 0])
+    lat = np.radians(coordinates[:, 1])
+    converted = np.empty((len(coordinates), 2), dtype=np.int64)
+    converted[:, 0] = np.floor(scale * (long + math.pi))
+    converted[:, 1] = np.floor(
+        scale * (math.pi - np.log(np.tan((math.pi / 4) + (lat / 2))))
+    )
+    return converted
+
+
+def get_tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """Return geographic bounds of map tile.
+
+    Inverse of Web Mercator projection, see convert_coordinates.
+
+    :return: Bounds in format (west, south, east, north) in degrees
+    """
+    tiles_count = 2**z
+
+    def latitude(tile_y: int) -> float:
+        return math.degrees(
+            math.atan(math.sinh(math.pi * (1 - 2 * tile_y / tiles_count)))
+        )
+
+    west = x / tiles_count * 360 - 180
+    east = (x + 1) / tiles_count * 360 - 180
+    return west, latitude(y + 1), east, latitude(y)
+
+
+def get_extent_polygons(extent: ExtentData) -> List[List[List[float]]]:
+    """Return outer rings of all polygons in GeoJSON.
 
-    :param tiles: Tiles for zooming in format [[z, x, y], ...]
+    Supported are Feature, FeatureCollection, GeometryCollection,
+    Polygon and MultiPolygon GeoJSON objects.
+
+    :return: Polygons in format [[[longitude, latitude], ...], ...]
+    """
+    if extent["type"] == "Feature":
+        return get_extent_polygons(extent["geometry"])
+    if extent["type"] == "FeatureCollection":
+        return [
+            polygon
+            for feature in extent["features"]
+            for polygon in get_extent_polygons(feature)
+        ]
+    if extent["type"] == "GeometryCollection":
+        return [
+            polygon
+            for geometry in extent["geometries"]
+            for polygon in get_extent_polygons(geometry)
+        ]
+    if extent["type"] == "Polygon":
+        return [extent["coordinates"][0]]
+    if extent["type"] == "MultiPolygon":
+        return [polygon[0] for polygon in extent["coordinates"]]
+    raise ValueError(f"Unsupported GeoJSON type: {extent['type']}")
+
+
+def is_point_in_polygon(longitude: float, latitude: float, polygon) -> bool:
+    """Return if point is inside of polygon (ray casting)."""
+    inside = False
+    for (start_lon, start_lat), (end_lon, end_lat) in zip(
+        polygon, polygon[1:] + polygon[:1]
+    ):
+        if (start_lat > latitude) != (end_lat > latitude):
+            slope = (end_lon - start_lon) / (end_lat - start_lat)
+            crossing = start_lon + (latitude - start_lat) * slope
+            if longitude < crossing:
+                inside = not inside
+    return inside
+
+
+def __get_polygon_edges(polygons) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Return edges of all polygons.
+
+    :return: Arrays of start points and end points of edges
+        in format [[longitude, latitude], ...] and indexes of first edge
+        of each polygon
+    """
+    rings = [np.array([point[:2] for point in polygon], float) for polygon in polygons]
+    starts = np.concatenate(rings)
+    ends = np.concatenate([np.roll(ring, -1, axis=0) for ring in rings])
+    first_edges = np.cumsum([0] + [len(ring) for ring in rings[:-1]])
+    return starts, ends, first_edges
+
+
+def __are_edges_in_bounds(starts: np.ndarray, ends: np.ndarray, bounds) -> np.ndarray:
+    """Return if any edge intersects bounds, for bounds of all tiles at once.
+
+    Liang-Barsky clipping of all edges by all bounds.
+
+    :param starts: Start points of edges from __get_polygon_edges
+    :param ends: End points of edges from __get_polygon_edges
+    :param bounds: Arrays (west, south, east, north), see TileSet.bounds
+    :return: Bool array, True for bounds intersected by any edge
+    """
+    west, south, east, north = (values[:, np.newaxis] for values in bounds)
+    delta_x = ends[:, 0] - starts[:, 0]
+    delta_y = ends[:, 1] - starts[:, 1]
+    ratio_min = np.zeros((len(west), len(starts)))
+    ratio_max = np.ones((len(west), len(starts)))
+    is_outside = np.zeros((len(west), len(starts)), dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for direction, distance in (
+            (-delta_x, starts[:, 0] - west),
+            (delta_x, east - starts[:, 0]),
+            (-delta_y, starts[:, 1] - south),
+            (delta_y, north - starts[:, 1]),
+        ):
+            ratio = distance / direction
+            is_outside |= (direction == 0) & (distance < 0)
+            ratio_min = np.where(direction < 0, np.maximum(ratio_min, ratio), ratio_min)
+            ratio_max = np.where(direction > 0, np.minimum(ratio_max, ratio), ratio_max)
+    return np.any(~is_outside & (ratio_min <= ratio_max), axis=1)
+
+
+def __are_points_in_polygons(
+    longitudes: np.ndarray,
+    latitudes: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    first_edges: np.ndarray,
+) -> np.ndarray:
+    """Return if points are inside of any polygon, for all points at once.
+
+    Same ray casting as is_point_in_polygon.
+
+    :param starts: Start points of edges from __get_polygon_edges
+    :param ends: End points of edges from __get_polygon_edges
+    :param first_edges: Indexes of first edges of polygons
+    :return: Bool array, True for points inside of any polygon
+    """
+    latitudes = latitudes[:, np.newaxis]
+    longitudes = longitudes[:, np.newaxis]
+    is_crossed = (starts[:, 1] > latitudes) != (ends[:, 1] > latitudes)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = (ends[:, 0] - starts[:, 0]) / (ends[:, 1] - starts[:, 1])
+        crossing = starts[:, 0] + (latitudes - starts[:, 1]) * slope
+    crossings = is_crossed & (longitudes < crossing)
+    crossing_counts = np.add.reduceat(crossings, first_edges, axis=1)
+    return np.any(crossing_counts % 2 == 1, axis=1)
+
+
+def cover_tiles(tiles: TileSet, zoom_to: int, extent: ExtentData) -> TileSet:
+    """Zoom tiles (see TileSet.zoom_to) and keep only tiles intersecting extent.
+
+    Tiles are zoomed in level by level. Tiles outside of bounding box
+    of extent are dropped at once, remaining tiles are tested against
+    extent polygons, all tiles of one level at once.
+    Only children of tiles on boundary of extent are tested, tiles fully
+    inside of extent are zoomed without testing, children of tiles outside
+    of extent are not generated at all.
+
+    :param tiles: Tiles for zooming
     :param zoom_to: Targeting zoom level
-    :return: Zoomed tiles
-    """
-    zoom_step = zoom_to - tiles[0][0]
-    if zoom_step <= 0:
-        return tiles
-    new_tiles = []
-    for tile in tiles:
-        x_start = tile[1] * 2**zoom_step
-        x_end = x_start + 2**zoom_step
-        y_start = tile[2] * 2**zoom_step
-        y_end = y_start + 2**zoom_step
-        for new_x in range(x_start, x_end):
-            for new_y in range(y_start, y_end):
-                new_tiles.append([zoom_to, new_x, new_y])
-    return new_tiles
+    :param extent: GeoJSON with area of interest
+    :return: Zoomed tiles intersecting extent
+    """
+    polygons = get_extent_polygons(extent)
+    starts, ends, first_edges = __get_polygon_edges(polygons)
+    extent_west, extent_south = starts.min(axis=0)
+    extent_east, extent_north = starts.max(axis=0)
+
+    def split_tiles(tiles: TileSet) -> Tuple[TileSet, TileSet]:
+        """Return tiles fully inside of extent and tiles on its boundary."""
+        west, south, east, north = tiles.bounds()
+        tiles = tiles.filter(
+            (west <= extent_east)
+            & (east >= extent_west)
+            & (south <= extent_north)
+            & (north >= extent_south)
+        )
+        west, south, east, north = bounds = tiles.bounds()
+        is_on_boundary = __are_edges_in_bounds(starts, ends, bounds)
+        is_inside = ~is_on_boundary & __are_points_in_polygons(
+            (west + east) / 2, (south + north) / 2, starts, ends, first_edges
+        )
+        return tiles.filter(is_inside), tiles.filter(is_on_boundary)
+
+    inner_tiles, boundary_tiles = split_tiles(tiles)
+    covering_tiles = [inner_tiles]
+    while boundary_tiles.zoom < zoom_to:
+        inner_tiles, boundary_tiles = split_tiles(
+            boundary_tiles.zoom_to(boundary_tiles.zoom + 1)
+        )
+        covering_tiles.append(inner_tiles)
+    return TileSet.union_all(zoom_to, covering_tiles + [boundary_tiles])